@@ -0,0 +1,215 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+import argparse
+import itertools
+import json
+import pathlib
+import statistics
+import subprocess
+import time
+
+import torch
+
+import transformer_flow
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, device: torch.device, warmup: int, repeats: int) -> dict[str, float]:
+    """Median wall time of fn over repeats runs after warmup runs, and the peak device memory of those runs"""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else None
+    return {'time': statistics.median(times), 'peak_memory_mib': peak}
+
+
+def benchmark_config(args, config: dict, device: torch.device) -> dict:
+    transformer_flow.Attention.USE_SPDA = config['attention'] == 'spda'
+    torch.manual_seed(0)
+    model = transformer_flow.Model(
+        in_channels=args.channel_size,
+        img_size=args.img_size,
+        patch_size=config['patch_size'],
+        channels=config['channels'],
+        num_blocks=config['blocks'],
+        layers_per_block=config['layers_per_block'],
+        num_classes=args.num_classes,
+    ).to(device)
+    B, T = args.batch_size, model.num_patches
+    x = torch.randn(B, args.channel_size, args.img_size, args.img_size, device=device)
+    y = torch.randint(args.num_classes, (B,), device=device) if args.num_classes else None
+    noise = torch.randn(B, T, model.pixel_channels, device=device)
+
+    def autocast():
+        return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.autocast)
+
+    def forward():
+        with torch.no_grad(), autocast():
+            model(x, y)
+
+    def reverse(guidance: float):
+        def run():
+            with torch.inference_mode(), autocast():
+                model.reverse(noise, y, guidance, annealed_guidance=True)
+
+        return run
+
+    block = model.blocks[-1]
+
+    def reverse_steps():
+        # every position of the last block with its kv cache, which is all a reverse pass does per block
+        with torch.inference_mode(), autocast():
+            z = block.permutation(noise)
+            pos_embed = block.permutation(block.pos_embed, dim=0)
+            block.set_sample_mode(True)
+            for i in range(T - 1):
+                block.reverse_step(z, pos_embed, i, y)
+            block.set_sample_mode(False)
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    def train_step():
+        # compute_loss in train.py, followed by backward and the optimizer step
+        optimizer.zero_grad()
+        with autocast():
+            z, _, logdets = model(x, y)
+            loss = model.get_loss(z, logdets)
+        loss.backward()
+        optimizer.step()
+
+    def block_times(run_block, h: torch.Tensor, blocks: list[int], repeats: int) -> list[float]:
+        """Median time of run_block(block, h) -> h for each block, chained in the given order as the full pass does"""
+        times = {i: [] for i in blocks}
+        for _ in range(args.warmup + repeats):
+            h_i = h.clone()  # reverse overwrites its input in place for identity permutations
+            for i in blocks:
+                synchronize(device)
+                start = time.perf_counter()
+                h_i = run_block(model.blocks[i], h_i)
+                synchronize(device)
+                times[i].append(time.perf_counter() - start)
+        return [statistics.median(times[i][args.warmup :]) for i in range(len(model.blocks))]
+
+    def forward_block(b, h):
+        with torch.no_grad(), autocast():
+            return b(h, y)[0]
+
+    def reverse_block(guidance: float):
+        def run(b, h):
+            with torch.inference_mode(), autocast():
+                return b.reverse(h, y, guidance, annealed_guidance=True)
+
+        return run
+
+    def train_block(b, h):
+        # forward and backward of one block on its own, the optimizer step is not included
+        h = h.detach().requires_grad_()
+        with autocast():
+            z, logdet = b(h, y)
+            loss = 0.5 * z.pow(2).mean() - logdet.mean()
+        loss.backward()
+        return z.detach()
+
+    results = {}
+    results['forward'] = measure(forward, device, args.warmup, args.repeats)
+    forward_order = list(range(len(model.blocks)))
+    reverse_order = forward_order[::-1]
+    h = model.patchify(x)
+    results['forward']['block_times'] = block_times(forward_block, h, forward_order, args.repeats)
+    results['reverse'] = measure(reverse(0), device, args.warmup, args.reverse_repeats)
+    results['reverse']['block_times'] = block_times(
+        reverse_block(0), noise * model.var.sqrt(), reverse_order, args.reverse_repeats
+    )
+    if args.num_classes and args.cfg > 0:
+        results['reverse_guided'] = measure(reverse(args.cfg), device, args.warmup, args.reverse_repeats)
+        results['reverse_guided']['block_times'] = block_times(
+            reverse_block(args.cfg), noise * model.var.sqrt(), reverse_order, args.reverse_repeats
+        )
+    results['reverse_step'] = measure(reverse_steps, device, args.warmup, args.reverse_repeats)
+    results['reverse_step']['time'] /= T - 1
+    results['train_step'] = measure(train_step, device, args.warmup, args.repeats)
+    results['train_step']['block_times'] = block_times(train_block, h, forward_order, args.repeats)
+    optimizer.zero_grad()
+    for name, r in results.items():
+        if name == 'reverse_step':  # one patch per sample and step
+            r['patches_per_s'] = B / r['time']
+            r['images_per_s'] = r['patches_per_s'] / T
+        else:
+            r['images_per_s'] = B / r['time']
+            r['patches_per_s'] = r['images_per_s'] * T
+    return {'config': config, 'num_params': sum(p.numel() for p in model.parameters()), 'results': results}
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    report = {
+        'revision': git_revision(),
+        'torch': torch.__version__,
+        'device': torch.cuda.get_device_name(device) if device.type == 'cuda' else device.type,
+        'args': {k: str(v) if isinstance(v, pathlib.Path) else v for k, v in vars(args).items()},
+        'runs': [],
+    }
+    sweep = itertools.product(args.patch_size, args.channels, args.blocks, args.layers_per_block, args.attention)
+    for patch_size, channels, blocks, layers_per_block, attention in sweep:
+        config = {
+            'patch_size': patch_size,
+            'channels': channels,
+            'blocks': blocks,
+            'layers_per_block': layers_per_block,
+            'attention': attention,
+        }
+        run = benchmark_config(args, config, device)
+        report['runs'].append(run)
+        print(' '.join(f'{k}={v}' for k, v in config.items()))
+        for name, r in run['results'].items():
+            memory = f'{r["peak_memory_mib"]:.0f}MiB' if r['peak_memory_mib'] is not None else '-'
+            print(f'\t{name:16s} {r["time"] * 1000:9.2f}ms {r["images_per_s"]:10.1f} img/s {r["patches_per_s"]:12.1f} patch/s {memory}')
+
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f'Saved results to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default=None, type=str, help='Device to benchmark on, defaults to cuda when available')
+    parser.add_argument('--output', default=None, type=pathlib.Path, help='JSON file for the results, to compare across commits')
+    parser.add_argument('--img_size', default=16, type=int, help='Image size')
+    parser.add_argument('--channel_size', default=3, type=int, help='Image channel size')
+    parser.add_argument('--num_classes', default=10, type=int, help='Number of classes, 0 for an unconditional model')
+    parser.add_argument('--batch_size', default=8, type=int, help='Batch size')
+    parser.add_argument('--patch_size', default=[4], type=int, nargs='+', help='Patch sizes to sweep')
+    parser.add_argument('--channels', default=[128], type=int, nargs='+', help='Model widths to sweep')
+    parser.add_argument('--blocks', default=[2], type=int, nargs='+', help='Numbers of flow blocks to sweep')
+    parser.add_argument('--layers_per_block', default=[2], type=int, nargs='+', help='Depths per flow block to sweep')
+    parser.add_argument('--attention', default=['spda', 'base'], nargs='+', choices=['spda', 'base'], help='Attention implementations to sweep (Attention.USE_SPDA)')
+    parser.add_argument('--cfg', default=2.0, type=float, help='Guidance weight for the guided reverse benchmark')
+    parser.add_argument('--autocast', default=False, action=argparse.BooleanOptionalAction, help='Run under bf16 autocast as in training and sampling')
+    parser.add_argument('--warmup', default=2, type=int, help='Untimed runs before timing')
+    parser.add_argument('--repeats', default=10, type=int, help='Timed runs of forward and train step')
+    parser.add_argument('--reverse_repeats', default=3, type=int, help='Timed runs of the reverse benchmarks')
+    args = parser.parse_args()
+
+    main(args)
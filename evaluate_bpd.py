@@ -1,4 +1,5 @@
 import argparse
+import builtins
 import os
 import pathlib
 
@@ -7,6 +8,7 @@ import torch
 import torch.utils.data
 import torchvision as tv
 import transformer_flow
+import utils
 
 
 def gaussian_log_prob(z: torch.Tensor, k: int = 128) -> torch.Tensor:
@@ -16,12 +18,18 @@ def gaussian_log_prob(z: torch.Tensor, k: int = 128) -> torch.Tensor:
 
 
 def main(args):
+    dist = utils.Distributed()
+    utils.set_random_seed(100 + dist.rank)
+
+    def print(*args, **kwargs):
+        if dist.local_rank == 0:
+            builtins.print(*args, **kwargs)
+
     transform = tv.transforms.Compose(
         [
             tv.transforms.Resize(args.img_size),
             tv.transforms.CenterCrop(args.img_size),
-            tv.transforms.ToTensor(),
-            tv.transforms.Normalize((0.5,), (0.5,)),
+            tv.transforms.PILToTensor(),
         ]
     )
     data = tv.datasets.ImageFolder(
@@ -31,14 +39,14 @@ def main(args):
 
     data_loader = torch.utils.data.DataLoader(
         data,
-        shuffle=False,
-        batch_size=args.batch_size,
+        sampler=utils.ShardSampler(len(data), dist.rank, dist.world_size),
+        batch_size=args.batch_size // dist.world_size,
         num_workers=8,
-        pin_memory=True,
+        pin_memory=dist.device.type == "cuda",
         drop_last=False,
     )
 
-    device = torch.device("cuda")
+    device = dist.device
     model = transformer_flow.Model(
         in_channels=args.channel_size,
         img_size=args.img_size,
@@ -51,41 +59,57 @@ def main(args):
     ).to(device)
 
     ckpt_file = args.ckpt_file
-    ckpt = torch.load(ckpt_file, map_location="cpu")
+    ckpt = utils.load_checkpoint(ckpt_file)
     model.load_state_dict(ckpt, strict=True)
     model.eval()
 
     print("Starting BPD evaluation")
 
-    all_bpd = 0
-    cnt = 0
-    n_dims = args.img_size * args.img_size * 3
-
-    for x, y in data_loader:
-        x = x.to(device)
-        x_int = (x + 1) * (255 / 2)
-        x = (x_int + torch.rand_like(x_int)) / 256
-        x = x * 2 - 1
+    K = args.num_draws
+    # sum of bpd, sum of importance weighted bpd and number of images, reduced across ranks at the end
+    totals = torch.zeros(3, dtype=torch.float64, device=device)
+    trace = None
+    if args.profile:
+        args.logdir.mkdir(parents=True, exist_ok=True)
+        trace_file = args.logdir / f"{args.dataset}_bpd_trace_rank{dist.rank}.json"
+        trace = utils.start_trace(trace_file, args.profile_steps, synchronize=args.profile_sync)
+
+    for i, (x, _) in enumerate(data_loader):
+        n_dims = x[0].numel()
+        # K dequantization draws per image, evaluated as one batch
+        x = utils.preprocess_batch(x.to(device, non_blocking=True).repeat_interleave(K, dim=0), "uniform")
         y = None
-        with torch.no_grad():
+        with torch.no_grad(), utils.profiler.range("forward"):
             z, outputs, logdets = model(x, y)
             prior_log_p = gaussian_log_prob(z)
-            nll = -prior_log_p / n_dims - logdets
-            bpd = nll / np.log(2)
-            batch_bpd = bpd.sum().item()
-            all_bpd += batch_bpd
-            cnt += z.size(0)
-            running_mean_bpd = all_bpd / cnt
-            print(f"Running mean BPD: {running_mean_bpd:.4f}")
-
-    final_bpd = all_bpd / cnt
-    print(f"BPD: {final_bpd:.4f}")
+            nll = (-prior_log_p / n_dims - logdets).double().view(-1, K)
+            bpd = nll.mean(dim=1) / np.log(2)
+            # -log (1/K sum_k p(x + u_k)), a tighter bound on the discrete likelihood than the mean
+            iw_nll = -(torch.logsumexp(-nll * n_dims, dim=1) - np.log(K)) / n_dims
+            iw_bpd = iw_nll / np.log(2)
+            totals += torch.stack([bpd.sum(), iw_bpd.sum(), totals.new_tensor(bpd.size(0))])
+        if i == 0 and args.round_trip_check:
+            with torch.inference_mode():
+                error = transformer_flow.round_trip_error(model, x, y)
+            print(f"Round trip: max abs error {error['max_abs_error']:.2e} rmse {error['rmse']:.2e}")
+        print(f"{i+1}/{len(data_loader)} batches complete")
+        if trace is not None:
+            trace.step()
+
+    if trace is not None:
+        trace.stop()
+        print(utils.profiler.summary())
+    bpd, iw_bpd, cnt = dist.all_reduce(totals).tolist()
+    print(f"Images: {int(cnt)}  Draws per image: {K}")
+    print(f"BPD: {bpd / cnt:.4f}")
+    print(f"Importance weighted BPD: {iw_bpd / cnt:.4f}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--data", default="data", type=pathlib.Path)
     parser.add_argument("--ckpt_file", default="", type=str)
+    parser.add_argument("--logdir", default="runs", type=pathlib.Path)
     parser.add_argument(
         "--dataset",
         default="imagenet64",
@@ -101,7 +125,12 @@ if __name__ == "__main__":
     parser.add_argument("--blocks", default=8, type=int)
     parser.add_argument("--layers_per_block", default=8, type=int)
     parser.add_argument("--nvp", default=1, type=int)
-    parser.add_argument("--batch_size", default=500, type=int)
+    parser.add_argument("--batch_size", default=500, type=int, help="Images per step across all devices")
+    parser.add_argument("--num_draws", default=1, type=int, help="Dequantization draws per image, the forward batch is batch_size * num_draws")
+    parser.add_argument("--round_trip_check", default=False, action=argparse.BooleanOptionalAction, help="Check that Model.reverse inverts Model.forward on the first batch")
+    parser.add_argument("--profile", default=False, action=argparse.BooleanOptionalAction, help="Trace a few batches to a Chrome trace in logdir and print per range timings")
+    parser.add_argument("--profile_steps", default=3, type=int, help="Number of batches in the profiler trace")
+    parser.add_argument("--profile_sync", default=False, action=argparse.BooleanOptionalAction, help="Synchronize the device around every profiler range, so that the range totals are device times")
 
     args = parser.parse_args()
 
@@ -16,7 +16,6 @@ import utils
 
 
 def main(args):
-    args.denoising_batch_size = args.batch_size // 4
     dist = utils.Distributed()
     utils.set_random_seed(100 + dist.rank)
     num_classes = utils.get_num_classes(args.dataset)
@@ -30,7 +29,8 @@ def main(args):
     fid_stats_file = args.data / f'{args.dataset}_{args.img_size}_fid_stats.pth'
     assert fid_stats_file.exists()
     print(f'Loading FID stats from {fid_stats_file}')
-    fid = utils.FID(reset_real_features=False, normalize=True).cuda()
+    device = dist.device
+    fid = utils.FID(reset_real_features=False, normalize=True).to(device)
     fid.load_state_dict(torch.load(fid_stats_file, map_location='cpu', weights_only=False))
     dist.barrier()
 
@@ -43,7 +43,7 @@ def main(args):
         layers_per_block=args.layers_per_block,
         nvp=args.nvp,
         num_classes=num_classes,
-    ).cuda()
+    ).to(device)
     for p in model.parameters():
         p.requires_grad = False
 
@@ -53,9 +53,13 @@ def main(args):
     if dist.local_rank == 0:
         sample_dir.mkdir(parents=True, exist_ok=True)
 
-    ckpt = torch.load(args.ckpt_file, map_location='cpu', weights_only=True)
+    ckpt = utils.load_checkpoint(args.ckpt_file)
     model.load_state_dict(ckpt, strict=True)
     model.eval()
+    transformer_flow.Attention.KV_CACHE_DTYPE = args.kv_cache_dtype
+
+    if args.static_sampler:
+        sampler = transformer_flow.StaticSampler(model, args.batch_size // dist.world_size, compile=args.compile)
 
     print('Starting sampling')
     num_batches = int(np.ceil(args.num_samples / args.batch_size))
@@ -63,53 +67,110 @@ def main(args):
 
     def get_noise(b):
         return torch.randn(
-            b, (args.img_size // args.patch_size) ** 2, args.channel_size * args.patch_size**2, device='cuda'
+            b, (args.img_size // args.patch_size) ** 2, args.channel_size * args.patch_size**2, device=device
         )
 
+    def generate(noise, y, static=False):
+        autocast = torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+        with torch.inference_mode(), autocast, utils.profiler.range('sample'):
+            if static:
+                samples = sampler(noise, y, args.cfg, attn_temp=args.attn_temp, annealed_guidance=True)
+            else:
+                samples = model.reverse(
+                    noise,
+                    y,
+                    args.cfg,
+                    attn_temp=args.attn_temp,
+                    annealed_guidance=True,
+                    batch_guidance=args.batch_guidance,
+                    jacobi=args.jacobi,
+                    jacobi_tol=args.jacobi_tol,
+                    jacobi_max_iters=args.jacobi_max_iters,
+                )
+            assert isinstance(samples, torch.Tensor)
+
+        if args.self_denoising_lr > 0:
+            with utils.profiler.range('denoise'):
+                samples = transformer_flow.self_denoise(
+                    model,
+                    samples,
+                    y,
+                    args.noise_std,
+                    args.self_denoising_lr,
+                    steps=args.self_denoising_steps,
+                    chunk_size=args.denoising_batch_size or None,
+                    memory_budget=int(args.denoising_memory_budget * 2**30) or None,
+                    checkpoint=args.denoising_checkpoint,
+                )
+        return samples.detach()
+
+    # Inception runs in the background on batch i while the flow samples batch i+1
+    fid_pipeline = utils.FIDPipeline(fid, max_pending=args.fid_queue_size)
+    trace = None
+    if args.profile:
+        trace_file = sample_dir / f'trace_cfg{args.cfg:.2f}_rank{dist.rank}.json'
+        trace = utils.start_trace(trace_file, args.profile_steps, synchronize=args.profile_sync)
+    num_resampled = 0
     for i in range(num_batches):
         noise = get_noise(args.batch_size // dist.world_size)
         if num_classes:
-            y = torch.randint(num_classes, (args.batch_size // dist.world_size,), device='cuda')
+            y = torch.randint(num_classes, (args.batch_size // dist.world_size,), device=device)
         else:
             y = None
+        if i == 0 and args.kv_cache_check:
+            with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                fidelity = transformer_flow.kv_cache_fidelity(
+                    model, noise, y, guidance=args.cfg, attn_temp=args.attn_temp, annealed_guidance=True
+                )
+            for storage, r in fidelity.items():
+                print(
+                    f'kv cache {storage:8s}: max abs error {r["max_abs_error"]:.4f} rmse {r["rmse"]:.5f} '
+                    f'psnr {r["psnr"]:.1f}dB, {r["cache_ratio"]:.2f}x the cache memory'
+                )
+        if i == 0 and args.static_sampler and args.static_sampler_check:
+            with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                errors = transformer_flow.static_sampler_error(
+                    sampler, noise, y, guidance=args.cfg, attn_temp=args.attn_temp, annealed_guidance=True
+                )
+            for name, error in errors.items():
+                print(f'static sampler, {name} attention: max abs error {error:.4f} against Model.reverse')
+            # the attention over full-length masked buffers reduces in a different order than the eager path
+            worst = max(errors.values())
+            assert worst <= args.static_sampler_tolerance, f'static sampler differs from Model.reverse by {worst:.4f}'
+        samples = generate(noise, y, static=args.static_sampler)
+        # redraw only the samples that are not finite, keeping their labels
         while True:
-            with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.bfloat16):
-                samples = model.reverse(noise, y, args.cfg, attn_temp=args.attn_temp, annealed_guidance=True)
-                assert isinstance(samples, torch.Tensor)
-
-            if args.self_denoising_lr > 0:
-                samples = samples.cpu()
-                assert args.batch_size % args.denoising_batch_size == 0
-                db = args.denoising_batch_size // dist.world_size
-                # This should be the theoretical optimal denoising lr
-                base_lr = db * args.img_size**2 * args.channel_size * args.noise_std**2
-                lr = args.self_denoising_lr * base_lr
-                denoised_samples = []
-                for j in range(args.batch_size // args.denoising_batch_size):
-                    x = torch.clone(samples[j * db : (j + 1) * db]).detach().cuda()
-                    x.requires_grad = True
-                    y_ = y[j * db : (j + 1) * db] if y is not None else None
-                    with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
-                        z, _, logdets = model(x, y_)
-                    loss = model.get_loss(z, logdets)
-                    grad = torch.autograd.grad(loss, [x])[0]
-                    x.data.add_(grad, alpha=-lr)
-                    denoised_samples.append(x.detach().cpu())
-                samples = torch.cat(denoised_samples, dim=0).cuda()
-
-            samples = dist.gather_concat(samples.detach())
-            if not samples.isnan().any().item():
+            failed = (~samples.flatten(1).isfinite().all(dim=1)).nonzero().squeeze(1)
+            if failed.numel() == 0:
                 break
-            else:
-                noise = get_noise(args.batch_size // dist.world_size)
+            num_resampled += failed.numel()
+            builtins.print(f'Rank {dist.rank}: resampling {failed.numel()} non-finite samples in batch {i+1}')
+            y_failed = y[failed] if y is not None else None
+            samples = samples.index_copy(0, failed, generate(get_noise(failed.numel()), y_failed))
 
+        # every rank extracts Inception features of its own samples only, the statistics are summed at the end
+        keep = samples.size(0)
         if i == num_batches - 1:
-            samples = samples[:last_batch_size]
-
-        fid.update(0.5 * (samples.clip(min=-1, max=1) + 1), real=False)
+            keep = max(0, min(keep, last_batch_size - dist.rank * keep))
+        if keep:
+            with utils.profiler.range('fid submit'):
+                fid_pipeline.submit(0.5 * (samples[:keep].clip(min=-1, max=1) + 1))
+        if trace is not None:
+            trace.step()
         print(f'{i+1}/{num_batches} batch sample complete')
+        if args.jacobi:
+            print('\tJacobi iterations', ' '.join(f'{s["iters"]}' for s in model.jacobi_stats))
+    fid_pipeline.join()
+    if trace is not None:
+        trace.stop()
+        print(utils.profiler.summary())
+    utils.health.report()
+    fid.reduce_features(dist)
     fid_score = fid.compute().item()
-    fid.reset()
+    fid.clear_features()
+    samples = dist.gather_concat(samples)[:last_batch_size]
+    num_resampled = dist.gather_concat(torch.tensor([num_resampled], device=device)).sum().item()
+    print(f'Resampled {num_resampled} non-finite samples in total')
 
     print(f'{args.ckpt_file} {model_name} cfg {args.cfg:.2f} fid {fid_score:.2f}')
     if dist.local_rank == 0:
@@ -135,9 +196,39 @@ if __name__ == '__main__':
     parser.add_argument('--nvp', default=True, action=argparse.BooleanOptionalAction, help='Whether to use the non volume preserving version')
     parser.add_argument('--cfg', default=0, type=float, help='Guidance weight for sampling, 0 is no guidance. For conditional models consider the range in [1, 3]')
     parser.add_argument('--attn_temp', default=1.0, type=float, help='Attention temperature for unconditional guidance, enabled when not 1 (eg, 0.5, 1.5)')
+    parser.add_argument('--batch_guidance', default=True, action=argparse.BooleanOptionalAction, help='Run the conditional and unconditional guidance streams as one stacked batch')
+    parser.add_argument('--jacobi', default=False, action=argparse.BooleanOptionalAction, help='Invert each block with parallel fixed-point iterations instead of patch by patch')
+    parser.add_argument('--jacobi_tol', default=1e-3, type=float, help='Stop the fixed-point iterations once no value changes by more than this')
+    parser.add_argument('--jacobi_max_iters', default=None, type=int, help='Cap on fixed-point iterations per block, defaults to the number of patches')
+    parser.add_argument('--static_sampler', default=False, action=argparse.BooleanOptionalAction, help='Sample with the static-shape engine (fixed batch, full-length kv cache)')
+    parser.add_argument(
+        '--static_sampler_check', default=False, action=argparse.BooleanOptionalAction, help='Compare the first batch of the static sampler against Model.reverse with both attention implementations'
+    )
+    parser.add_argument('--static_sampler_tolerance', default=1e-2, type=float, help='Largest sample difference --static_sampler_check accepts')
+    parser.add_argument(
+        '--compile', default=False, action=argparse.BooleanOptionalAction, help='Compile the static sampler step with torch.compile, expect the first batch to be slow when enabled'
+    )
+    parser.add_argument(
+        '--kv_cache_dtype', default=None, choices=['float16', 'bfloat16', 'int8'], help='Storage of the sampling kv cache, defaults to the compute dtype, int8 uses per head and position scales'
+    )
+    parser.add_argument(
+        '--kv_cache_check', default=False, action=argparse.BooleanOptionalAction, help='Compare the first batch sampled with each low precision kv cache against the full precision one'
+    )
+    parser.add_argument(
+        '--profile', default=False, action=argparse.BooleanOptionalAction, help='Trace a few batches to a Chrome trace in the sample folder and print per range timings, slows the traced batches down'
+    )
+    parser.add_argument('--profile_steps', default=2, type=int, help='Number of batches in the profiler trace')
+    parser.add_argument(
+        '--profile_sync', default=False, action=argparse.BooleanOptionalAction, help='Synchronize the device around every profiler range, so that the range totals are device times'
+    )
     parser.add_argument('--batch_size', default=1024, type=int, help='Batch size for drawing samples')
     parser.add_argument('--num_samples', default=50000, type=int, help='Number of total samples to draw')
+    parser.add_argument('--fid_queue_size', default=2, type=int, help='Number of sampled batches that can wait for Inception feature extraction')
     parser.add_argument('--self_denoising_lr', default=1.0, type=float, help='Learning rate multiplier for denoising, 1 is the theoretical optimal one')
+    parser.add_argument('--self_denoising_steps', default=1, type=int, help='Number of gradient steps for denoising')
+    parser.add_argument('--denoising_batch_size', default=0, type=int, help='Per-device chunk size for denoising, 0 picks it from the memory budget')
+    parser.add_argument('--denoising_memory_budget', default=0, type=float, help='Memory budget in GiB for denoising chunks, 0 uses most of the free device memory')
+    parser.add_argument('--denoising_checkpoint', default=False, action=argparse.BooleanOptionalAction, help='Recompute each flow block during denoising to fit larger chunks')
 
     args = parser.parse_args()
 
@@ -0,0 +1,82 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+import argparse
+import json
+import pathlib
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision as tv
+
+import utils
+
+
+def main(args):
+    transform = tv.transforms.Compose(
+        [
+            tv.transforms.Resize(args.img_size),
+            tv.transforms.CenterCrop(args.img_size),
+            tv.transforms.PILToTensor(),
+        ]
+    )
+    data = utils.load_dataset(args.dataset, args.data, transform)
+    cache_dir = utils.get_cache_dir(args.dataset, args.img_size, args.data)
+    assert not (cache_dir / 'meta.json').exists(), f'{cache_dir} already exists'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    data_loader = torch.utils.data.DataLoader(
+        data, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, drop_last=False
+    )
+
+    num_images = len(data)
+    shape = (args.channel_size, args.img_size, args.img_size)
+    shards = []
+    for start in range(0, num_images, args.shard_size):
+        size = min(args.shard_size, num_images - start)
+        k = len(shards)
+        shards.append({'images': f'images_{k:04d}.npy', 'labels': f'labels_{k:04d}.npy', 'size': size})
+
+    def open_shard(k):
+        size = shards[k]['size']
+        images = np.lib.format.open_memmap(cache_dir / shards[k]['images'], mode='w+', dtype=np.uint8, shape=(size, *shape))
+        return images, np.zeros(size, dtype=np.int64)
+
+    k, offset = 0, 0
+    images, labels = open_shard(k)
+    for i, (x, y) in enumerate(data_loader):
+        x, y = x.numpy(), y.numpy()
+        while len(x):
+            n = min(len(x), shards[k]['size'] - offset)
+            images[offset : offset + n] = x[:n]
+            labels[offset : offset + n] = y[:n]
+            x, y, offset = x[n:], y[n:], offset + n
+            if offset == shards[k]['size']:
+                images.flush()
+                np.save(cache_dir / shards[k]['labels'], labels)
+                del images
+                k, offset = k + 1, 0
+                if k < len(shards):
+                    images, labels = open_shard(k)
+        print(f'{min((i + 1) * args.batch_size, num_images)}/{num_images} images cached')
+
+    # written last, so that get_data only picks up complete caches
+    meta = {'dataset': args.dataset, 'img_size': args.img_size, 'num_images': num_images, 'shards': shards}
+    (cache_dir / 'meta.json').write_text(json.dumps(meta, indent=2))
+    print(f'Saved {len(shards)} shards to {cache_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default='data', type=pathlib.Path, help='Path for training data')
+    parser.add_argument('--dataset', default='imagenet', choices=['imagenet', 'imagenet64', 'afhq', 'cifar'], help='Name of dataset')
+    parser.add_argument('--img_size', default=64, type=int, help='Image size')
+    parser.add_argument('--channel_size', default=3, type=int, help='Image channel size')
+    parser.add_argument('--shard_size', default=100000, type=int, help='Number of images per shard')
+    parser.add_argument('--batch_size', default=256, type=int, help='Batch size for decoding')
+    parser.add_argument('--num_workers', default=8, type=int, help='Number of decoding workers')
+    args = parser.parse_args()
+
+    main(args)
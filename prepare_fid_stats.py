@@ -5,34 +5,85 @@
 import argparse
 import pathlib
 
+import numpy as np
 import torch
 import torch.utils.data
 
 import utils
 
 
+def save_stats_from_store(args, fid: utils.FID, store_dir: pathlib.Path):
+    """Derive global or per-class FID stats from stored Inception features, without running Inception"""
+    features = np.load(store_dir / 'features.npy', mmap_mode='r')
+    labels = np.load(store_dir / 'labels.npy')
+    if args.per_class:
+        subsets = {f'_class{c}': np.flatnonzero(labels == c) for c in np.unique(labels)}
+    else:
+        subsets = {'': np.arange(len(labels))}
+
+    for suffix, indices in subsets.items():
+        fid.clear_features(real=True)
+        for start in range(0, len(indices), args.batch_size):
+            chunk = features[indices[start : start + args.batch_size]]
+            fid.update_features(torch.from_numpy(chunk).to(fid.device), real=True)
+        stats_file = args.data / f'{args.dataset}_{args.img_size}_fid_stats{suffix}.pth'
+        torch.save(fid.state_dict(), stats_file)
+        print(f'Saved FID stats file {stats_file} ({len(indices)} images)')
+
+
 def main(args):
 
-    print(f"Using GPU: {torch.cuda.current_device()} - {torch.cuda.get_device_name(torch.cuda.current_device())}")
     dist = utils.Distributed()
-    data, _ = utils.get_data(args.dataset, args.img_size, args.data)
+    if dist.device.type == 'cuda':
+        print(f"Using GPU: {torch.cuda.current_device()} - {torch.cuda.get_device_name(torch.cuda.current_device())}")
+    else:
+        print(f'Using CPU with {torch.get_num_threads()} threads')
+    fid = utils.FID(reset_real_features=False, normalize=True).to(dist.device)
+    store_dir = args.data / f'{args.dataset}_{args.img_size}_inception'
+    if args.from_feature_store:
+        if dist.rank == 0:
+            save_stats_from_store(args, fid, store_dir)
+        dist.barrier()
+        return
 
+    data, _ = utils.get_data(args.dataset, args.img_size, args.data)
     fid_stats_file = args.data / f'{args.dataset}_{args.img_size}_fid_stats.pth'
     assert not fid_stats_file.exists()
-    fid = utils.FID(reset_real_features=False, normalize=True).cuda()
-    dist.barrier()
+
+    if args.feature_store:
+        # per-image features and labels, keyed by dataset index
+        if dist.rank == 0:
+            store_dir.mkdir(parents=True, exist_ok=True)
+            num_features = fid.real_features_sum.numel()
+            np.lib.format.open_memmap(store_dir / 'features.npy', mode='w+', dtype=np.float32, shape=(len(data), num_features))
+            np.lib.format.open_memmap(store_dir / 'labels.npy', mode='w+', dtype=np.int64, shape=(len(data),))
+        dist.barrier()
+        store_features = np.load(store_dir / 'features.npy', mmap_mode='r+')
+        store_labels = np.load(store_dir / 'labels.npy', mmap_mode='r+')
 
     data_sampler = torch.utils.data.DistributedSampler(
-        data, num_replicas=dist.world_size, rank=dist.local_rank, shuffle=False
+        data, num_replicas=dist.world_size, rank=dist.rank, shuffle=False
     )
     data_loader = torch.utils.data.DataLoader(
         data, sampler=data_sampler, batch_size=args.batch_size // dist.world_size, num_workers=8, drop_last=False
     )
+    indices = np.array(list(data_sampler))
 
-    for x, _ in data_loader:
-        x = x.cuda()
-        fid.update(dist.gather_concat(0.5 * (x + 1)), real=True)
+    offset = 0
+    for x, y in data_loader:
+        x = utils.preprocess_batch(x.to(dist.device, non_blocking=True), flip=True)
+        features = fid.extract_features(0.5 * (x + 1))
+        fid.update_features(features, real=True)
+        if args.feature_store:
+            batch_indices = indices[offset : offset + x.size(0)]
+            store_features[batch_indices] = features.float().cpu().numpy()
+            store_labels[batch_indices] = y.numpy()
+        offset += x.size(0)
+    fid.reduce_features(dist, real=True)
 
+    if args.feature_store:
+        store_features.flush()
+        store_labels.flush()
     if dist.local_rank == 0:
         torch.save(fid.state_dict(), fid_stats_file)
         print(f'Saved FID stats file {fid_stats_file}')
@@ -46,6 +97,15 @@ if __name__ == '__main__':
     parser.add_argument('--img_size', default=32, type=int, help='Image size')
     parser.add_argument('--channel_size', default=3, type=int, help='Image channel size')
     parser.add_argument('--batch_size', default=1024, type=int, help='Batch size')
+    parser.add_argument(
+        '--feature_store', default=False, action=argparse.BooleanOptionalAction, help='Also save per-image Inception features and labels to a memory-mapped store'
+    )
+    parser.add_argument(
+        '--from_feature_store', default=False, action=argparse.BooleanOptionalAction, help='Derive the FID stats from a previously saved feature store instead of running Inception'
+    )
+    parser.add_argument(
+        '--per_class', default=False, action=argparse.BooleanOptionalAction, help='With --from_feature_store, save one stats file per class'
+    )
     args = parser.parse_args()
 
     main(args)
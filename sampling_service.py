@@ -0,0 +1,180 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2024 Apple Inc. All Rights Reserved.
+#
+import asyncio
+import collections
+import dataclasses
+import time
+
+import numpy as np
+import torch
+
+import transformer_flow
+
+
+@dataclasses.dataclass
+class SampleRequest:
+    num_samples: int
+    y: torch.Tensor | None
+    cfg: float
+    attn_temp: float
+    future: asyncio.Future
+    submitted: float
+    scheduled: int = 0
+    parts: list[torch.Tensor] = dataclasses.field(default_factory=list)
+
+    @property
+    def key(self) -> tuple[float, float, bool]:
+        # only requests with the same sampling settings can share a Model.reverse call
+        return self.cfg, self.attn_temp, self.y is None
+
+
+class SamplingService:
+    """
+    In-process sampling service that coalesces queued requests into batches of up to max_batch_size samples,
+    waiting at most max_latency seconds for a batch to fill, and runs them through Model.reverse one at a time.
+
+    Usage:
+        service = SamplingService(model, max_batch_size=256)
+        await service.start()
+        images = await service.sample(16, y=torch.full((16,), 3), cfg=2.0)
+        await service.stop()
+    """
+
+    def __init__(
+        self,
+        model: transformer_flow.Model,
+        max_batch_size: int,
+        max_latency: float = 0.05,
+        autocast_dtype: torch.dtype | None = torch.bfloat16,
+        annealed_guidance: bool = True,
+        latency_window: int = 10000,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.autocast_dtype = autocast_dtype
+        self.annealed_guidance = annealed_guidance
+        self.device = model.var.device
+        self.conditional = model.blocks[0].class_embed is not None
+        self.pending: collections.OrderedDict[tuple[float, float, bool], collections.deque[SampleRequest]] = (
+            collections.OrderedDict()
+        )
+        self.arrived = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.num_batches = 0
+        self.num_batched_samples = 0
+        self.latencies: collections.deque[float] = collections.deque(maxlen=latency_window)
+
+    async def start(self) -> None:
+        assert self.task is None, 'service already started'
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def sample(
+        self, num_samples: int, y: torch.Tensor | None = None, cfg: float = 0, attn_temp: float = 1.0
+    ) -> torch.Tensor:
+        """Queue a request for num_samples images and wait for them (on the model device), y holds one label per sample"""
+        assert num_samples > 0
+        if not self.conditional:
+            y = None
+        if y is not None:
+            assert y.numel() == num_samples, 'expected one label per sample'
+            y = y.view(-1).to(self.device)
+        future = asyncio.get_running_loop().create_future()
+        request = SampleRequest(num_samples, y, cfg, attn_temp, future, time.perf_counter())
+        self.pending.setdefault(request.key, collections.deque()).append(request)
+        self.arrived.set()
+        return await request.future
+
+    def queue_depth(self) -> int:
+        return sum(r.num_samples - r.scheduled for q in self.pending.values() for r in q)
+
+    def stats(self) -> dict[str, float]:
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'queue_depth': self.queue_depth(),
+            'batches': self.num_batches,
+            'batch_fill_ratio': self.num_batched_samples / max(1, self.num_batches * self.max_batch_size),
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p99': float(np.percentile(latencies, 99)),
+        }
+
+    def next_batch(self) -> list[tuple[SampleRequest, int, int]]:
+        """Take up to max_batch_size rows from the queue holding the oldest request, as (request, start, end)"""
+        key = min(self.pending, key=lambda k: self.pending[k][0].submitted)
+        queue = self.pending[key]
+        batch = []
+        size = 0
+        while queue and size < self.max_batch_size:
+            request = queue[0]
+            n = min(request.num_samples - request.scheduled, self.max_batch_size - size)
+            batch.append((request, request.scheduled, request.scheduled + n))
+            request.scheduled += n
+            size += n
+            if request.scheduled == request.num_samples:
+                queue.popleft()
+        if not queue:
+            del self.pending[key]
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self.arrived.clear()
+                await self.arrived.wait()
+            # wait for the batch to fill, up to the latency budget of the oldest request
+            oldest = min(q[0].submitted for q in self.pending.values())
+            while self.queue_depth() < self.max_batch_size:
+                timeout = oldest + self.max_latency - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self.next_batch()
+            request = batch[0][0]
+            y = None
+            if request.y is not None:
+                y = torch.cat([r.y[start:end] for r, start, end in batch if r.y is not None])
+            size = sum(end - start for _, start, end in batch)
+            try:
+                samples = await loop.run_in_executor(None, self.reverse, size, y, request.cfg, request.attn_temp)
+            except Exception as e:
+                for r, _, _ in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                continue
+
+            self.num_batches += 1
+            self.num_batched_samples += size
+            offset = 0
+            for r, start, end in batch:
+                r.parts.append(samples[offset : offset + end - start])
+                offset += end - start
+                if end == r.num_samples and not r.future.done():
+                    r.future.set_result(torch.cat(r.parts))
+                    self.latencies.append(time.perf_counter() - r.submitted)
+
+    def reverse(self, batch_size: int, y: torch.Tensor | None, cfg: float, attn_temp: float) -> torch.Tensor:
+        model = self.model
+        noise = torch.randn(batch_size, model.num_patches, model.pixel_channels, device=self.device)
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None
+        ):
+            samples = model.reverse(noise, y, cfg, attn_temp=attn_temp, annealed_guidance=self.annealed_guidance)
+        assert isinstance(samples, torch.Tensor)
+        return samples
@@ -4,13 +4,20 @@
 #
 import argparse
 import builtins
+import contextlib
 import pathlib
+import time
 
 import torch
 import torch.amp
 import torch.utils
 import torch.utils.data
 import torchvision as tv
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.distributed.fsdp import FullOptimStateDictConfig, FullStateDictConfig, ShardingStrategy, StateDictType
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
+from torch.distributed.fsdp.wrap import ModuleWrapPolicy
 
 import transformer_flow
 import utils
@@ -25,11 +32,14 @@ def main(args):
         if dist.local_rank == 0:
             builtins.print(*args, **kwargs)
 
+    utils.health.configure(enabled=args.health_checks, interval=args.health_check_interval)
+
     print(f'{" Config ":-^80}')
     for k, v in sorted(vars(args).items()):
         print(f'{k:32s}: {v}')
 
-    fid = utils.FID(reset_real_features=False, normalize=True).to('cuda')
+    device = dist.device
+    fid = utils.FID(reset_real_features=False, normalize=True).to(device)
     fid_stats_file = args.data / f'{args.dataset}_{args.img_size}_fid_stats.pth'
     if fid_stats_file.exists():
         print(f'Loading FID stats from {fid_stats_file}')
@@ -47,14 +57,20 @@ def main(args):
         fixed_y = torch.randint(num_classes, (args.num_samples // dist.world_size,))
     else:
         fixed_y = None
-    data_sampler = torch.utils.data.DistributedSampler(data, num_replicas=dist.world_size, rank=dist.rank, shuffle=True)
+    data_sampler = utils.ResumableSampler(data, num_replicas=dist.world_size, rank=dist.rank, shuffle=True)
+    # every optimizer step accumulates the gradients of grad_accum micro-batches
+    assert args.batch_size % (dist.world_size * args.grad_accum) == 0, 'batch_size must divide into micro-batches'
+    # the worker seeds come from their own generator, reseeded every epoch, so that creating the iterator does not
+    # draw from the global RNG and a resumed run continues with the same random numbers
+    loader_generator = torch.Generator()
     data_loader = torch.utils.data.DataLoader(
         data,
         sampler=data_sampler,
-        batch_size=args.batch_size // dist.world_size,
+        batch_size=args.batch_size // dist.world_size // args.grad_accum,
         num_workers=8,
-        pin_memory=True,
+        pin_memory=device.type == 'cuda',
         drop_last=True,
+        generator=loader_generator,
     )
 
     model = transformer_flow.Model(
@@ -66,24 +82,72 @@ def main(args):
         layers_per_block=args.layers_per_block,
         nvp=args.nvp,
         num_classes=num_classes,
-    ).to('cuda')
-    optimizer = torch.optim.AdamW(model.parameters(), betas=(0.9, 0.95), lr=args.lr, weight_decay=1e-4)
-    lr_schedule = utils.CosineLRSchedule(optimizer, len(data_loader), args.epochs * len(data_loader), 1e-6, args.lr)
-    scaler = torch.amp.GradScaler()
+    ).to(device)
+    model.set_checkpointing(args.checkpointing, args.checkpoint_every)
+    enable_amp = args.noise_type == 'gaussian'
+
+    if args.checkpointing_report:
+        x, y = next(iter(data_loader))
+        x = utils.preprocess_batch(x.to(device), args.noise_type, args.noise_std)
+        y = y.to(device) if num_classes else None
+        print(f'{" Checkpointing ":-^80}')
+        report = transformer_flow.checkpointing_report(model, x, y, autocast_dtype=torch.bfloat16 if enable_amp else None)
+        for r in report:
+            print(
+                f'\t{r["mode"]:6s} every {r["every"]}: peak memory {r["peak_memory_gib"]:.2f} GiB '
+                f'(activations estimated at {r["estimated_gib"]:.2f} GiB), {r["step_time"] * 1000:.1f} ms per step'
+            )
+
+    ckpt = None
     if args.resume:
-        ckpt = torch.load(args.resume, map_location='cpu')
-        model.load_state_dict(ckpt)
-        ckpt = torch.load(args.resume.replace('_model_', '_opt_'), map_location='cpu')
-        optimizer.load_state_dict(ckpt['optimizer'])
-        lr_schedule.load_state_dict(ckpt['lr_schedule'])
-        del ckpt
-        print(f'Loaded checkpoint {args.resume}')
+        # loaded before wrapping, so that sharding starts from the full checkpoint
+        model.load_state_dict(utils.load_checkpoint(args.resume))
+        ckpt = utils.load_checkpoint(args.resume.replace('_model_', '_opt_'))
 
-    if dist.distributed:
-        model_ddp = torch.nn.parallel.DistributedDataParallel(model, device_ids=[dist.local_rank])
+    param_names = [name for name, _ in model.named_parameters()]
+    sharded = args.sharding != 'none'
+    if sharded:
+        assert dist.distributed and device.type == 'cuda', '--sharding needs torchrun with one GPU per rank'
+        model_ddp = FSDP(
+            model,
+            auto_wrap_policy=ModuleWrapPolicy({transformer_flow.MetaBlock}),
+            sharding_strategy=ShardingStrategy.FULL_SHARD if args.sharding == 'full' else ShardingStrategy.SHARD_GRAD_OP,
+            device_id=device,
+            use_orig_params=True,
+        )
+    elif dist.distributed:
+        device_ids = [dist.local_rank] if device.type == 'cuda' else None
+        model_ddp = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
     else:
         model_ddp = model
 
+    # with sharding, every rank only holds and updates the optimizer state of its own parameter shards
+    optimizer = torch.optim.AdamW(model_ddp.parameters(), betas=(0.9, 0.95), lr=args.lr, weight_decay=1e-4)
+    steps_per_epoch = len(data_loader) // args.grad_accum
+    lr_schedule = utils.CosineLRSchedule(optimizer, steps_per_epoch, args.epochs * steps_per_epoch, 1e-6, args.lr)
+    scaler = ShardedGradScaler(device.type) if sharded else torch.amp.GradScaler(device.type)
+    start_epoch, start_step = 0, 0
+    if ckpt is not None:
+        if sharded:
+            optimizer_state = utils.optimizer_state_by_name(ckpt['optimizer'], param_names)
+            optimizer.load_state_dict(FSDP.optim_state_dict_to_load(model_ddp, optimizer, optimizer_state))
+        else:
+            optimizer.load_state_dict(ckpt['optimizer'])
+        lr_schedule.load_state_dict(ckpt['lr_schedule'])
+        if 'scaler' in ckpt:
+            scaler.load_state_dict(ckpt['scaler'])
+        # checkpoints from before step-level resume only have the above, and restart at epoch 0
+        start_epoch, start_step = ckpt.get('epoch', 0), ckpt.get('step', 0)
+        if start_step >= steps_per_epoch:  # saved after the last step of an epoch
+            start_epoch, start_step = start_epoch + 1, 0
+        if 'rng' in ckpt:
+            if len(ckpt['rng']) == dist.world_size:
+                utils.set_rng_state(ckpt['rng'][dist.rank])
+            else:
+                print(f'Checkpoint was saved with {len(ckpt["rng"])} ranks, not restoring the RNG states')
+        del ckpt
+        print(f'Loaded checkpoint {args.resume}, resuming at epoch {start_epoch + 1} step {start_step}')
+
     if args.noise_type == 'gaussian':
         model_name = f'{args.patch_size}_{args.channels}_{args.blocks}_{args.layers_per_block}_{args.noise_std:.2f}'
     else:
@@ -93,10 +157,52 @@ def main(args):
     opt_ckpt_file = args.logdir / f'{args.dataset}_opt_{model_name}.pth'
     if dist.local_rank == 0:
         sample_dir.mkdir(parents=True, exist_ok=True)
+    ckpt_writer = utils.CheckpointWriter(keep=args.keep_checkpoints)
+    if dist.rank == 0 and args.keep_checkpoints > 1:
+        # tagged checkpoints of an earlier run count towards --keep_checkpoints
+        for path in (model_ckpt_file, opt_ckpt_file):
+            ckpt_writer.track_existing(path, 'epoch', 'ep[0-9][0-9][0-9]')
+            ckpt_writer.track_existing(path, 'step', 'ep[0-9][0-9][0-9]_step[0-9][0-9][0-9][0-9][0-9][0-9]')
+    preemption = utils.PreemptionHandler(dist, interval=args.preempt_check_interval)
+
+    def full_state_dicts() -> tuple[dict, dict]:
+        """Model and optimizer state dicts in the unsharded format, with sharding they are gathered to rank 0 only"""
+        if not sharded:
+            return model.state_dict(), optimizer.state_dict()
+        with FSDP.state_dict_type(
+            model_ddp,
+            StateDictType.FULL_STATE_DICT,
+            FullStateDictConfig(offload_to_cpu=True, rank0_only=True),
+            FullOptimStateDictConfig(offload_to_cpu=True, rank0_only=True),
+        ):
+            model_state = model_ddp.state_dict()
+            optimizer_state = FSDP.optim_state_dict(model_ddp, optimizer)
+        if dist.rank == 0:
+            optimizer_state = utils.optimizer_state_by_index(optimizer_state, param_names)
+        return model_state, optimizer_state
+
+    def save_checkpoint(epoch: int, step: int, tag: str, series: str = 'epoch'):
+        """Checkpoint after `step` steps of `epoch`, only the copy to host memory happens here"""
+        rng = dist.gather_object(utils.get_rng_state())
+        model_state, optimizer_state = full_state_dicts()
+        # a single writer, other nodes would race it for the same temporary files in a shared logdir
+        if dist.rank == 0:
+            train_state = {
+                'optimizer': optimizer_state,
+                'lr_schedule': lr_schedule.state_dict(),
+                'scaler': scaler.state_dict(),
+                'epoch': epoch,
+                'step': step,
+                'rng': rng,
+            }
+            ckpt_writer.save(
+                {model_ckpt_file: model_state, opt_ckpt_file: train_state},
+                tag=tag if args.keep_checkpoints > 1 else None,
+                series=series,
+            )
 
-    enable_amp = args.noise_type == 'gaussian'
     def compute_loss(x, y):
-        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=enable_amp):
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enable_amp):
             z, outputs, logdets = model_ddp(x, y)
             loss = model.get_loss(z, logdets)
             return loss, (z, outputs, logdets)
@@ -105,66 +211,154 @@ def main(args):
         compute_loss = torch.compile(compute_loss, fullgraph=False, backend='inductor', mode='max-autotune')
         dist.barrier()
 
+    trace = None
+    if args.profile:
+        trace_file = args.logdir / f'{args.dataset}_trace_{model_name}_rank{dist.rank}.json'
+        trace = utils.start_trace(trace_file, args.profile_steps, synchronize=args.profile_sync)
+
+    def synchronized_time() -> float:
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    grad_comm_time = 0.0
+    time_grad_comm = args.comm_timing and isinstance(model_ddp, torch.nn.parallel.DistributedDataParallel)
+    if time_grad_comm:
+
+        def timed_all_reduce(process_group, bucket: torch.distributed.GradBucket) -> torch.futures.Future:
+            # waits for every bucket, so while timing the reduction no longer overlaps the rest of backward
+            nonlocal grad_comm_time
+            start = synchronized_time()
+            future = default_hooks.allreduce_hook(process_group, bucket)
+            future.wait()
+            grad_comm_time += synchronized_time() - start
+            return future
+
+        model_ddp.register_comm_hook(None, timed_all_reduce)
+    elif args.comm_timing and sharded:
+        print('--comm_timing does not measure the gradient reduce-scatter of sharded training')
+
+    K = args.grad_accum
+    micro_batch_size = data_loader.batch_size
+    assert micro_batch_size is not None
+    prior_z2 = torch.zeros(model.num_patches, model.pixel_channels, device=device)
+
     print(f'{" Training ":-^80}')
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
+        step = start_step if epoch == start_epoch else 0
+        data_sampler.set_epoch(epoch, start_index=step * K * micro_batch_size)
+        loader_generator.manual_seed(100 + epoch * dist.world_size + dist.rank)
         metrics = utils.Metrics()
-        for x, y in data_loader:
-            x = x.cuda()
-            if args.noise_type == 'gaussian':
-                eps = args.noise_std * torch.randn_like(x)
-                x = x + eps
-            elif args.noise_type == 'uniform':
-                x_int = (x + 1) * (255 / 2)
-                x = (x_int + torch.rand_like(x_int)) / 256
-                x = x * 2 - 1
-            if num_classes:
-                y = y.cuda()
-                mask = (torch.rand(y.size(0), device='cuda') < args.drop_label).int()
-                # we use -1 to denote dropped classes
-                y = (1 - mask) * y - mask
-            else:
-                y = None
-            optimizer.zero_grad()
-            loss, (z, outputs, logdets) = compute_loss(x, y)
+        # an incomplete accumulation at the end of the epoch is skipped
+        num_micro_steps = len(data_loader) // K * K
+        for micro_step, (x, y) in enumerate(data_loader):
+            if micro_step == num_micro_steps:
+                break
+            last = (micro_step + 1) % K == 0
+            with utils.profiler.range('preprocess'):
+                x = utils.preprocess_batch(x.to(device, non_blocking=True), args.noise_type, args.noise_std, flip=True)
+                if num_classes:
+                    y = y.to(device)
+                    mask = (torch.rand(y.size(0), device=device) < args.drop_label).int()
+                    # we use -1 to denote dropped classes
+                    y = (1 - mask) * y - mask
+                else:
+                    y = None
+            if micro_step % K == 0:
+                optimizer.zero_grad()
+            # gradients are only reduced across ranks in the backward pass of the last micro-batch
+            no_sync = not last and model_ddp is not model
+            with model_ddp.no_sync() if no_sync else contextlib.nullcontext():
+                with utils.profiler.range('forward'):
+                    loss, (z, outputs, logdets) = compute_loss(x, y)
+                if args.comm_timing:
+                    start = synchronized_time()
+                with utils.profiler.range('backward'):
+                    scaler.scale(loss / K).backward()
+                if args.comm_timing:
+                    metrics.update({'time/backward': synchronized_time() - start})
             if not args.nvp:
-                model.update_prior(dist.gather_concat(z.detach().square().mean(dim=0, keepdim=True).sqrt()))
-            dist.barrier()
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-            current_lr = lr_schedule.step()
+                prior_z2 += z.detach().float().square().mean(dim=0)
             metrics.update({'loss': loss, 'loss/mse(z)': 0.5 * (z**2).mean(), 'loss/log(|det|)': logdets.mean()})
+            if not last:
+                continue
+            if time_grad_comm:
+                metrics.update({'time/grad_all_reduce': grad_comm_time})
+                grad_comm_time = 0.0
+
+            if not args.nvp:
+                # the prior statistics of all micro-batches and ranks are reduced while the optimizer steps
+                prior_work = dist.all_reduce_async(prior_z2)
+            with utils.profiler.range('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+            if not args.nvp:
+                if args.comm_timing:
+                    start = synchronized_time()
+                if prior_work is not None:
+                    prior_work.wait()
+                if args.comm_timing:
+                    metrics.update({'time/prior_all_reduce': synchronized_time() - start})
+                # update_prior averages squares, pass the root mean square over all samples
+                model.update_prior(prior_z2.div_(K * dist.world_size).sqrt().unsqueeze(0))
+                prior_z2.zero_()
+            current_lr = lr_schedule.step()
+            if trace is not None:
+                trace.step()
+            utils.health.step()
+            step += 1
+            if preemption.should_stop(step):
+                if step == steps_per_epoch:
+                    epoch, step = epoch + 1, 0
+                save_checkpoint(epoch, step, tag=f'ep{epoch+1:03d}_step{step:06d}', series='step')
+                ckpt_writer.close()
+                print(f'Stopped at epoch {epoch + 1} step {step} on request, resume from {model_ckpt_file}')
+                return
+            # the last step of an epoch is covered by the epoch checkpoint below
+            if args.ckpt_every_steps and step % args.ckpt_every_steps == 0 and step < steps_per_epoch:
+                save_checkpoint(epoch, step, tag=f'ep{epoch+1:03d}_step{step:06d}', series='step')
             if args.dry_run:
                 break
 
+        utils.health.report()
         metrics_dict = {'lr': current_lr, **metrics.compute(dist)}
         if dist.local_rank == 0:
             metrics.print(metrics_dict, epoch + 1)
             print('\tLayer norm', ' '.join([f'{z.pow(2).mean():.4f}' for z in outputs]))
-            torch.save(model.state_dict(), model_ckpt_file)
-            torch.save({'optimizer': optimizer.state_dict(), 'lr_schedule': lr_schedule.state_dict()}, opt_ckpt_file)
-        dist.barrier()
+            if args.profile and utils.profiler.totals:
+                print(utils.profiler.summary())
+        utils.profiler.reset()
+        save_checkpoint(epoch + 1, 0, tag=f'ep{epoch+1:03d}')
 
         if (epoch + 1) % args.sample_freq == 0:
-            for i in range(args.num_samples // args.sample_batch_size):
-                b = args.sample_batch_size // dist.world_size
-                noise = fixed_noise[i * b : (i + 1) * b].to('cuda')
-                y = None if fixed_y is None else fixed_y[i * b : (i + 1) * b].to('cuda')
-                with torch.no_grad():
-                    with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
-                        samples = model.reverse(noise, y, guidance=args.cfg)
-                        assert isinstance(samples, torch.Tensor)
-                    samples = dist.gather_concat(samples)
-                    fid.update(0.5 * (samples.clip(min=-1, max=1) + 1), real=False)
-                if args.dry_run:
-                    break
+            # sampling calls into the blocks directly, bypassing the sharded forward
+            full_params = FSDP.summon_full_params(model_ddp, writeback=False) if sharded else contextlib.nullcontext()
+            with full_params:
+                for i in range(args.num_samples // args.sample_batch_size):
+                    b = args.sample_batch_size // dist.world_size
+                    noise = fixed_noise[i * b : (i + 1) * b].to(device)
+                    y = None if fixed_y is None else fixed_y[i * b : (i + 1) * b].to(device)
+                    with torch.no_grad():
+                        autocast = torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+                        with autocast, utils.profiler.range('sampling'):
+                            samples = model.reverse(noise, y, guidance=args.cfg)
+                            assert isinstance(samples, torch.Tensor)
+                        with utils.profiler.range('fid'):
+                            fid.update(0.5 * (samples.clip(min=-1, max=1) + 1), real=False)
+                    if args.dry_run:
+                        break
+            fid.reduce_features(dist)
             fid_score = fid.compute().item()
-            fid.reset()
+            fid.clear_features()
+            samples = dist.gather_concat(samples)
 
             if dist.local_rank == 0:
                 utils.Metrics.print({'fid': fid_score}, epoch + 1)
                 tv.utils.save_image(samples, sample_dir / f'samples_{epoch+1:03d}.png', normalize=True, nrow=16)
             dist.barrier()
+    if trace is not None:
+        trace.stop()
+    ckpt_writer.close()
 
 
 if __name__ == '__main__':
@@ -185,6 +379,7 @@ if __name__ == '__main__':
     parser.add_argument('--cfg', default=0, type=float, help='Guidance weight for sampling, 0 is no guidance')
 
     parser.add_argument('--batch_size', default=128, type=int, help='Training batch size across all devices')
+    parser.add_argument('--grad_accum', default=1, type=int, help='Micro-batches per optimizer step, batch_size is split between them')
     parser.add_argument('--epochs', default=100, type=int, help='Training epochs')
     parser.add_argument('--lr', default=1e-4, type=float, help='Maximum learning rate')
     parser.add_argument('--drop_label', default=0, type=float, help='Ratio for random label drop in conditional mode')
@@ -192,11 +387,38 @@ if __name__ == '__main__':
     parser.add_argument('--num_samples', default=4096, type=int, help='Number of sampels to draw')
     parser.add_argument('--sample_batch_size', default=256, type=int, help='Batch size for drawing samples')
     parser.add_argument('--resume', default='', type=str, help='path for checkpoint to resume training from')
+    parser.add_argument('--ckpt_every_steps', default=0, type=int, help='Steps between mid-epoch checkpoints, 0 only saves at the end of each epoch')
+    parser.add_argument('--preempt_check_interval', default=10, type=int, help='Steps between checks whether any rank received SIGTERM')
+    parser.add_argument('--keep_checkpoints', default=1, type=int, help='Number of per-epoch checkpoints to keep, and separately of mid-epoch ones, 1 only keeps the latest checkpoint')
 
     parser.add_argument('--nvp', default=True, action=argparse.BooleanOptionalAction, help='Whether to use the non volume preserving version')
     parser.add_argument(
         '--compile', default=False, action=argparse.BooleanOptionalAction, help='Whether to use torch.compile, expect the first epoch to be slow when enabled'
     )
+    parser.add_argument(
+        '--health_checks', default=True, action=argparse.BooleanOptionalAction, help='Count NaN/Inf values in block outputs and logdets'
+    )
+    parser.add_argument('--health_check_interval', default=0, type=int, help='Steps between reports of the NaN/Inf counts, 0 reports once per epoch')
+    parser.add_argument(
+        '--sharding', default='none', choices=['none', 'full', 'grad_op'], help='Shard parameters, gradients and optimizer state (full) or only gradients and optimizer state (grad_op) across ranks with FSDP, one unit per flow block'
+    )
+    parser.add_argument(
+        '--checkpointing', default='none', choices=['none', 'block', 'layer'], help='Recompute MetaBlocks or AttentionBlocks in backward instead of storing their activations'
+    )
+    parser.add_argument('--checkpoint_every', default=1, type=int, help='Only checkpoint every k-th block or layer')
+    parser.add_argument(
+        '--checkpointing_report', default=False, action=argparse.BooleanOptionalAction, help='Print the peak memory and step time of every checkpointing mode on the first batch before training'
+    )
+    parser.add_argument(
+        '--comm_timing', default=False, action=argparse.BooleanOptionalAction, help='Report the backward time per micro-batch and the gradient and prior all_reduce times per step, synchronizes the device and serializes the gradient all_reduce to measure them'
+    )
+    parser.add_argument(
+        '--profile', default=False, action=argparse.BooleanOptionalAction, help='Trace a few steps to a Chrome trace in logdir and print per range timings of the traced steps, slows those steps down'
+    )
+    parser.add_argument('--profile_steps', default=5, type=int, help='Number of steps in the profiler trace')
+    parser.add_argument(
+        '--profile_sync', default=False, action=argparse.BooleanOptionalAction, help='Synchronize the device around every profiler range, so that the range totals are device times'
+    )
     parser.add_argument(
         '--dry_run', default=False, action=argparse.BooleanOptionalAction, help='Dry run for quick tests'
     )
@@ -2,10 +2,16 @@
 # For licensing see accompanying LICENSE file.
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
+import math
+import time
+
 import torch
-from utils import nan_or_inf
+import torch.utils.checkpoint
+from utils import health, profiler
 
 class Permutation(torch.nn.Module):
+    # whether the permutation reverses the sequence, MetaBlock.forward then runs on the original order instead
+    flip: bool = False
 
     def __init__(self, seq_length: int):
         super().__init__()
@@ -21,12 +27,147 @@ class PermutationIdentity(Permutation):
 
 
 class PermutationFlip(Permutation):
+    flip = True
+
     def forward(self, x: torch.Tensor, dim: int = 1, inverse: bool = False) -> torch.Tensor:
         return x.flip(dims=[dim])
 
 
+class KVCache:
+    """
+    Preallocated key/value buffers of shape (B, heads, max_length, head_dim) with a write cursor. With storage set,
+    keys and values are kept in float16, bfloat16 or int8 (with one scale per head and position) and converted back
+    to the dtype they were computed in when read.
+    """
+
+    STORAGE_DTYPES = {'float16': torch.float16, 'bfloat16': torch.bfloat16, 'int8': torch.int8}
+
+    def __init__(self, max_length: int, storage: str | None = None):
+        assert storage is None or storage in self.STORAGE_DTYPES, f'Unknown kv cache storage {storage}'
+        self.max_length = max_length
+        self.storage = storage
+        self.dtype: torch.dtype | None = None
+        self.k: torch.Tensor | None = None
+        self.v: torch.Tensor | None = None
+        self.k_scale: torch.Tensor | None = None
+        self.v_scale: torch.Tensor | None = None
+        self.positions: torch.Tensor | None = None
+        self.pos = 0
+
+    def allocate(
+        self, batch_size: int, num_heads: int, head_dim: int, dtype: torch.dtype, device: torch.device | str
+    ) -> None:
+        self.dtype = dtype
+        storage_dtype = self.STORAGE_DTYPES[self.storage] if self.storage else dtype
+        self.k = torch.zeros(batch_size, num_heads, self.max_length, head_dim, dtype=storage_dtype, device=device)
+        self.v = torch.zeros_like(self.k)
+        if self.storage == 'int8':
+            self.k_scale = torch.zeros(batch_size, num_heads, self.max_length, 1, dtype=torch.float16, device=device)
+            self.v_scale = torch.zeros_like(self.k_scale)
+        self.positions = torch.arange(self.max_length, device=device)
+        self.pos = 0
+
+    def clear(self) -> None:
+        for buffer in (self.k, self.v, self.k_scale, self.v_scale):
+            if buffer is not None:
+                buffer.zero_()
+        self.pos = 0
+
+    def nbytes(self) -> int:
+        buffers = (self.k, self.v, self.k_scale, self.v_scale)
+        return sum(b.numel() * b.element_size() for b in buffers if b is not None)
+
+    def quantize(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor | None]:
+        assert self.k is not None
+        if self.storage != 'int8':
+            return x.to(self.k.dtype), None
+        scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-6) / 127
+        return (x.float() / scale).round().to(torch.int8), scale.half()
+
+    def dequantize(self, x: torch.Tensor, scale: torch.Tensor | None) -> torch.Tensor:
+        assert self.dtype is not None
+        if scale is None:
+            return x.to(self.dtype)
+        return x.to(self.dtype) * scale.to(self.dtype)
+
+    def append(self, k: torch.Tensor, v: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Write k, v (b, h, t, d) at the cursor and return everything written so far"""
+        if self.k is None:
+            B, H, _, D = k.size()
+            self.allocate(B, H, D, k.dtype, k.device)
+        assert self.k is not None and self.v is not None
+        T = k.size(2)
+        end = self.pos + T
+        self.k[:, :, self.pos : end], k_scale = self.quantize(k)
+        self.v[:, :, self.pos : end], v_scale = self.quantize(v)
+        if self.k_scale is not None and self.v_scale is not None:
+            self.k_scale[:, :, self.pos : end] = k_scale
+            self.v_scale[:, :, self.pos : end] = v_scale
+            k_scale, v_scale = self.k_scale[:, :, :end], self.v_scale[:, :, :end]
+        self.pos = end
+        return self.dequantize(self.k[:, :, :end], k_scale), self.dequantize(self.v[:, :, :end], v_scale)
+
+    def write(self, k: torch.Tensor, v: torch.Tensor, pos: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Write a single step k, v (b, h, 1, d) at the position tensor pos and return the full buffers"""
+        assert self.k is not None and self.v is not None, 'static decoding needs an allocated cache'
+        k, k_scale = self.quantize(k)
+        v, v_scale = self.quantize(v)
+        self.k.index_copy_(2, pos.view(1), k)
+        self.v.index_copy_(2, pos.view(1), v)
+        if self.k_scale is not None and self.v_scale is not None:
+            self.k_scale.index_copy_(2, pos.view(1), k_scale)
+            self.v_scale.index_copy_(2, pos.view(1), v_scale)
+        return self.dequantize(self.k, self.k_scale), self.dequantize(self.v, self.v_scale)
+
+
+class AffineCoupling(torch.autograd.Function):
+    """
+    z_t = (x_t - b_t-1) * exp(-a_t-1) and z_1 = x_1, with h = [a, b] the conditioner outputs before the shift. The
+    shift is done by indexing and z is written once into its output tensor. With flip the sequence runs backwards,
+    z_t = (x_t - b_t+1) * exp(-a_t+1) and z_T = x_T, which is the coupling of the flipped sequence, flipped back.
+    """
+
+    @staticmethod
+    def slices(T: int, flip: bool) -> tuple[slice, slice, int]:
+        """output positions, the conditioner positions they use, and the position that is passed through"""
+        if flip:
+            return slice(0, T - 1), slice(1, T), T - 1
+        return slice(1, T), slice(0, T - 1), 0
+
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, h: torch.Tensor, nvp: bool, flip: bool) -> torch.Tensor:
+        C = x.size(2)
+        dst, src, keep = AffineCoupling.slices(x.size(1), flip)
+        z = torch.empty_like(x, dtype=torch.promote_types(x.dtype, h.dtype))
+        z[:, keep] = x[:, keep]
+        torch.sub(x[:, dst], h[:, src, -C:], out=z[:, dst])
+        if nvp:
+            z[:, dst].mul_((-h[:, src, :C].float()).exp().type(h.dtype))
+        ctx.save_for_backward(h, z)
+        ctx.nvp, ctx.flip, ctx.x_dtype = nvp, flip, x.dtype
+        return z
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, None, None]:
+        h, z = ctx.saved_tensors
+        C = z.size(2)
+        dst, src, _ = AffineCoupling.slices(z.size(1), ctx.flip)
+        grad_x = grad.to(ctx.x_dtype, copy=True)
+        grad_h = torch.zeros_like(h)
+        if ctx.nvp:
+            scale = (-h[:, src, :C].float()).exp().type(h.dtype)
+            grad_x[:, dst].mul_(scale)
+            grad_h[:, src, C:] = -grad_x[:, dst]
+            grad_h[:, src, :C] = -grad[:, dst] * z[:, dst]
+        else:
+            grad_h[:, src] = -grad[:, dst]
+        return grad_x, grad_h, None, None
+
+
 class Attention(torch.nn.Module):
     USE_SPDA: bool = True
+    # storage of the sampling kv cache, None keeps the dtype of the keys and values, see KVCache
+    KV_CACHE_DTYPE: str | None = None
 
     def __init__(self, in_channels: int, head_channels: int):
         assert in_channels % head_channels == 0
@@ -37,22 +178,48 @@ class Attention(torch.nn.Module):
         self.num_heads = in_channels // head_channels
         self.sqrt_scale = head_channels ** (-0.25)
         self.sample = False
-        self.k_cache: dict[str, list[torch.Tensor]] = {'cond': [], 'uncond': []}
-        self.v_cache: dict[str, list[torch.Tensor]] = {'cond': [], 'uncond': []}
+        self.kv_cache: dict[str, KVCache] = {}
+
+    def reset_cache(self, max_length: int):
+        self.kv_cache = {
+            'cond': KVCache(max_length, self.KV_CACHE_DTYPE),
+            'uncond': KVCache(max_length, self.KV_CACHE_DTYPE),
+        }
+
+    def update_cache(
+        self, k: torch.Tensor, v: torch.Tensor, which_cache: str, pos: torch.Tensor | None = None
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor | None]:
+        """
+        k, v (b, h, t, d) -> all cached keys and values. With pos given the full-length buffers are returned
+        together with a (1, t) mask over the positions written so far, so every step has the same shapes
+        """
+        cache = self.kv_cache[which_cache]
+        if pos is None:
+            k, v = cache.append(k, v)
+            return k, v, None
+        k, v = cache.write(k, v, pos)
+        assert cache.positions is not None
+        return k, v, (cache.positions <= pos).view(1, -1)
 
     def forward_spda(
-        self, x: torch.Tensor, mask: torch.Tensor | None = None, temp: float = 1.0, which_cache: str = 'cond'
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor | None = None,
+        temp: float | torch.Tensor = 1.0,
+        which_cache: str = 'cond',
+        pos: torch.Tensor | None = None,
     ) -> torch.Tensor:
         B, T, C = x.size()
         x = self.norm(x.float()).type(x.dtype)
         q, k, v = self.qkv(x).reshape(B, T, 3 * self.num_heads, -1).transpose(1, 2).chunk(3, dim=1)  # (b, h, t, d)
 
         if self.sample:
-            self.k_cache[which_cache].append(k)
-            self.v_cache[which_cache].append(v)
-            k = torch.cat(self.k_cache[which_cache], dim=2)  # note that sequence dimension is now 2
-            v = torch.cat(self.v_cache[which_cache], dim=2)
+            k, v, cache_mask = self.update_cache(k, v, which_cache, pos)  # note that sequence dimension is now 2
+            mask = cache_mask if cache_mask is not None else mask
 
+        if isinstance(temp, torch.Tensor):  # per-sample temperature, folded into the queries
+            q = q / temp.view(-1, 1, 1, 1).to(q.dtype)
+            temp = 1.0
         scale = self.sqrt_scale**2 / temp
         if mask is not None:
             mask = mask.bool()
@@ -62,17 +229,24 @@ class Attention(torch.nn.Module):
         return x
 
     def forward_base(
-        self, x: torch.Tensor, mask: torch.Tensor | None = None, temp: float = 1.0, which_cache: str = 'cond'
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor | None = None,
+        temp: float | torch.Tensor = 1.0,
+        which_cache: str = 'cond',
+        pos: torch.Tensor | None = None,
     ) -> torch.Tensor:
         B, T, C = x.size()
         x = self.norm(x.float()).type(x.dtype)
         q, k, v = self.qkv(x).reshape(B, T, 3 * self.num_heads, -1).chunk(3, dim=2)
         if self.sample:
-            self.k_cache[which_cache].append(k)
-            self.v_cache[which_cache].append(v)
-            k = torch.cat(self.k_cache[which_cache], dim=1)
-            v = torch.cat(self.v_cache[which_cache], dim=1)
+            # the cache is laid out as (b, h, t, d), read it back as (b, t, h, d) views
+            k, v, cache_mask = self.update_cache(k.transpose(1, 2), v.transpose(1, 2), which_cache, pos)
+            k, v = k.transpose(1, 2), v.transpose(1, 2)
+            mask = cache_mask if cache_mask is not None else mask
 
+        if isinstance(temp, torch.Tensor):  # per-sample temperature
+            temp = temp.view(-1, 1, 1, 1).to(q.dtype)
         attn = torch.einsum('bmhd,bnhd->bmnh', q * self.sqrt_scale, k * self.sqrt_scale) / temp
         if mask is not None:
             attn = attn.masked_fill(mask.unsqueeze(-1) == 0, float('-inf'))
@@ -83,11 +257,16 @@ class Attention(torch.nn.Module):
         return x
 
     def forward(
-        self, x: torch.Tensor, mask: torch.Tensor | None = None, temp: float = 1.0, which_cache: str = 'cond'
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor | None = None,
+        temp: float | torch.Tensor = 1.0,
+        which_cache: str = 'cond',
+        pos: torch.Tensor | None = None,
     ) -> torch.Tensor:
         if self.USE_SPDA:
-            return self.forward_spda(x, mask, temp, which_cache)
-        return self.forward_base(x, mask, temp, which_cache)
+            return self.forward_spda(x, mask, temp, which_cache, pos)
+        return self.forward_base(x, mask, temp, which_cache, pos)
 
 
 class MLP(torch.nn.Module):
@@ -111,9 +290,14 @@ class AttentionBlock(torch.nn.Module):
         self.mlp = MLP(channels, expansion)
 
     def forward(
-        self, x: torch.Tensor, attn_mask: torch.Tensor | None = None, attn_temp: float = 1.0, which_cache: str = 'cond'
+        self,
+        x: torch.Tensor,
+        attn_mask: torch.Tensor | None = None,
+        attn_temp: float | torch.Tensor = 1.0,
+        which_cache: str = 'cond',
+        pos: torch.Tensor | None = None,
     ) -> torch.Tensor:
-        x = x + self.attention(x, attn_mask, attn_temp, which_cache)
+        x = x + self.attention(x, attn_mask, attn_temp, which_cache, pos)
         x = x + self.mlp(x)
         return x
 
@@ -149,30 +333,62 @@ class MetaBlock(torch.nn.Module):
         self.proj_out.weight.data.fill_(0.0)
         self.permutation = permutation
         self.register_buffer('attn_mask', torch.tril(torch.ones(num_patches, num_patches)))
+        # recompute every k-th attention block in backward instead of storing its activations, 0 disables
+        self.checkpoint_every = 0
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor | None = None) -> tuple[torch.Tensor, torch.Tensor]:
-        """
-        x_T' <- (x_T-b(x_1, ..., x_T-1)) * exp(-a(x_1, ..., x_T-1))
-        this part can be paralleled, by using attn_mask
-        """
-        x = self.permutation(x)
-        pos_embed = self.permutation(self.pos_embed, dim=0)
-        x_in = x
+    def embed_class(self, y: torch.Tensor | None = None) -> torch.Tensor | None:
+        """Class embeddings, y=None or negative labels select the unconditional (mean) embedding"""
+        if self.class_embed is None:
+            return None
+        if y is None:
+            return self.class_embed.mean(dim=0)
+        if (y < 0).any():
+            m = (y < 0).float().view(-1, 1, 1)
+            return (1 - m) * self.class_embed[y] + m * self.class_embed.mean(dim=0)
+        return self.class_embed[y]
+
+    def guided_class_embed(self, y: torch.Tensor | None, batch_size: int) -> torch.Tensor | None:
+        """Class embeddings for a stacked [conditional; unconditional] batch of size 2B"""
+        if self.class_embed is None:
+            return None
+        uncond_embed = self.class_embed.mean(dim=0, keepdim=True).expand(batch_size, -1, -1)
+        cond_embed = self.class_embed[y] if y is not None else uncond_embed
+        return torch.cat([cond_embed, uncond_embed])
+
+    def conditioner_outputs(
+        self,
+        x: torch.Tensor,
+        pos_embed: torch.Tensor,
+        attn_mask: torch.Tensor,
+        class_embed: torch.Tensor | None = None,
+        attn_temp: float | torch.Tensor = 1.0,
+    ) -> torch.Tensor:
+        """[a, b] for all positions of x in one masked pass, before the shift"""
         x = self.proj_in(x) + pos_embed
-        if self.class_embed is not None:
-            if y is not None:
-                if (y < 0).any():
-                    m = (y < 0).float().view(-1, 1, 1)
-                    class_embed = (1 - m) * self.class_embed[y] + m * self.class_embed.mean(dim=0)
+        if class_embed is not None:
+            x = x + class_embed
+
+        checkpoint = self.checkpoint_every and torch.is_grad_enabled()
+        for j, block in enumerate(self.attn_blocks):
+            with profiler.range('AttentionBlock', j):
+                if checkpoint and j % self.checkpoint_every == 0:
+                    x = torch.utils.checkpoint.checkpoint(block, x, attn_mask, attn_temp, use_reentrant=False)
                 else:
-                    class_embed = self.class_embed[y]
-                x = x + class_embed
-            else:
-                x = x + self.class_embed.mean(dim=0)
+                    x = block(x, attn_mask, attn_temp)
+        return self.proj_out(x)
 
-        for block in self.attn_blocks:
-            x = block(x, self.attn_mask)
-        x = self.proj_out(x)
+    def conditioners(
+        self,
+        x: torch.Tensor,
+        pos_embed: torch.Tensor,
+        class_embed: torch.Tensor | None = None,
+        attn_temp: float | torch.Tensor = 1.0,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        a and b for all positions of the permuted sequence x in one masked pass,
+        shifted so that position t only depends on x_1, ..., x_t-1
+        """
+        x = self.conditioner_outputs(x, pos_embed, self.attn_mask, class_embed, attn_temp)
         x = torch.cat([torch.zeros_like(x[:, :1]), x[:, :-1]], dim=1) # to make x_1 unchanged, a and b for x_1 should be 0
 
         if self.nvp:
@@ -180,9 +396,25 @@ class MetaBlock(torch.nn.Module):
         else:
             xb = x
             xa = torch.zeros_like(x)
+        return xa, xb
 
-        scale = (-xa.float()).exp().type(xa.dtype)
-        return self.permutation((x_in - xb) * scale, inverse=True), -xa.mean(dim=[1, 2])
+    def forward(self, x: torch.Tensor, y: torch.Tensor | None = None) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        x_T' <- (x_T-b(x_1, ..., x_T-1)) * exp(-a(x_1, ..., x_T-1))
+        this part can be paralleled, by using attn_mask
+        a flipped block runs on the original order with an anti-causal mask, every patch keeps its own positional
+        embedding as it would when sequence and table are flipped together
+        """
+        flip = self.permutation.flip
+        attn_mask = self.attn_mask.t() if flip else self.attn_mask
+        h = self.conditioner_outputs(x, self.pos_embed, attn_mask, self.embed_class(y))
+        z = AffineCoupling.apply(x, h, self.nvp, flip)
+        if not self.nvp:
+            return z, h.new_zeros(h.size(0))
+        T, C = x.size(1), x.size(2)
+        _, src, _ = AffineCoupling.slices(T, flip)
+        # the first position of the permuted sequence has a = 0
+        return z, -h[:, src, :C].sum(dim=[1, 2]) / (T * C)
 
     def reverse_step(
         self,
@@ -205,8 +437,9 @@ class MetaBlock(torch.nn.Module):
             else:
                 x = x + self.class_embed.mean(dim=0)
 
-        for block in self.attn_blocks:
-            x = block(x, attn_temp=attn_temp, which_cache=which_cache)  # here we use kv caching, so no attn_mask
+        for j, block in enumerate(self.attn_blocks):
+            with profiler.range('AttentionBlock', j):
+                x = block(x, attn_temp=attn_temp, which_cache=which_cache)  # here we use kv caching, so no attn_mask
         x = self.proj_out(x)
 
         if self.nvp:
@@ -216,12 +449,49 @@ class MetaBlock(torch.nn.Module):
             xa = torch.zeros_like(x)
         return xa, xb
 
+    def reverse_step_guided(
+        self,
+        x: torch.Tensor,
+        pos_embed: torch.Tensor,
+        i: int,
+        class_embed: torch.Tensor | None = None,
+        attn_temp: float | torch.Tensor = 1.0,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        same as reverse_step, but the conditional and unconditional streams are stacked into one 2B batch
+        that shares a single kv cache, the first B rows of the outputs are conditional
+        """
+        x_in = x[:, i : i + 1]
+        x = self.proj_in(x_in) + pos_embed[i : i + 1]
+        x = torch.cat([x, x])
+        if class_embed is not None:
+            x = x + class_embed
+
+        for j, block in enumerate(self.attn_blocks):
+            with profiler.range('AttentionBlock', j):
+                x = block(x, attn_temp=attn_temp, which_cache='cond')
+        x = self.proj_out(x)
+
+        if self.nvp:
+            xa, xb = x.chunk(2, dim=-1)
+        else:
+            xb = x
+            xa = torch.zeros_like(x)
+        return xa, xb
+
+    @staticmethod
+    def guided_attn_temp(x: torch.Tensor, attn_temp: float) -> float | torch.Tensor:
+        """Per-row temperatures for a stacked guidance batch, attn_temp only applies to the unconditional half"""
+        if attn_temp == 1.0:
+            return 1.0
+        B = x.size(0)
+        return torch.cat([x.new_ones(B), x.new_full((B,), attn_temp)])
+
     def set_sample_mode(self, flag: bool = True):
         for m in self.modules():
             if isinstance(m, Attention):
                 m.sample = flag
-                m.k_cache = {'cond': [], 'uncond': []}
-                m.v_cache = {'cond': [], 'uncond': []}
+                m.reset_cache(self.attn_mask.size(0))
 
     def reverse(
         self,
@@ -231,15 +501,31 @@ class MetaBlock(torch.nn.Module):
         guide_what: str = 'ab',
         attn_temp: float = 1.0,
         annealed_guidance: bool = False,
+        batch_guidance: bool = True,
     ) -> torch.Tensor:
         x = self.permutation(x)
         pos_embed = self.permutation(self.pos_embed, dim=0)
         self.set_sample_mode(True)
         T = x.size(1)
+        guided = guidance > 0 and bool(guide_what)
+        batched = guided and batch_guidance
+        if batched:
+            class_embed = self.guided_class_embed(y, x.size(0))
+            temp = self.guided_attn_temp(x, attn_temp)
+
         for i in range(x.size(1) - 1):
-            za, zb = self.reverse_step(x, pos_embed, i, y, which_cache='cond')
-            if guidance > 0 and guide_what:
-                za_u, zb_u = self.reverse_step(x, pos_embed, i, None, attn_temp=attn_temp, which_cache='uncond')
+            if batched:
+                with profiler.range('reverse_step_guided'):
+                    za, zb = self.reverse_step_guided(x, pos_embed, i, class_embed, temp)
+                za, za_u = za.chunk(2)
+                zb, zb_u = zb.chunk(2)
+            else:
+                with profiler.range('reverse_step'):
+                    za, zb = self.reverse_step(x, pos_embed, i, y, which_cache='cond')
+                if guided:
+                    with profiler.range('reverse_step unconditional'):
+                        za_u, zb_u = self.reverse_step(x, pos_embed, i, None, attn_temp=attn_temp, which_cache='uncond')
+            if guided:
                 if annealed_guidance:
                     g = (i + 1) / (T - 1) * guidance
                 else:
@@ -254,6 +540,62 @@ class MetaBlock(torch.nn.Module):
         self.set_sample_mode(False)
         return self.permutation(x, inverse=True)
 
+    def reverse_jacobi(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor | None = None,
+        guidance: float = 0,
+        guide_what: str = 'ab',
+        attn_temp: float = 1.0,
+        annealed_guidance: bool = False,
+        tol: float = 1e-3,
+        max_iters: int | None = None,
+    ) -> tuple[torch.Tensor, dict[str, float]]:
+        """
+        x^(k+1)_T' <- exp(a(x^(k)_1', ..., x^(k)_T-1'))x_T + b(x^(k)_1', ..., x^(k)_T-1')
+        fixed-point (Jacobi) iteration of the parallel masked pass, after k iterations the first k+1
+        positions are exact, so it converges in at most T-1 iterations
+        """
+        z = self.permutation(x)
+        pos_embed = self.permutation(self.pos_embed, dim=0)
+        B, T, _ = z.size()
+        assert max_iters is None or max_iters >= 0, f'max_iters must not be negative, got {max_iters}'
+        max_iters = T - 1 if max_iters is None else min(max_iters, T - 1)
+        guided = guidance > 0 and bool(guide_what)
+        if guided:
+            class_embed = self.guided_class_embed(y, B)
+            temp = self.guided_attn_temp(z, attn_temp)
+            if annealed_guidance:
+                g = torch.arange(T, device=z.device).view(1, T, 1) / (T - 1) * guidance
+            else:
+                g = guidance
+        else:
+            class_embed = self.embed_class(y)
+
+        x = z
+        # without iterations only a single position is exact
+        stats = {'iters': 0, 'residual': 0.0, 'converged': float(T == 1)}
+        for k in range(max_iters):
+            if guided:
+                xa, xb = self.conditioners(torch.cat([x, x]), pos_embed, class_embed, temp)
+                xa, xa_u = xa.chunk(2)
+                xb, xb_u = xb.chunk(2)
+                if 'a' in guide_what:
+                    xa = xa + g * (xa - xa_u)
+                if 'b' in guide_what:
+                    xb = xb + g * (xb - xb_u)
+            else:
+                xa, xb = self.conditioners(x, pos_embed, class_embed)
+
+            x_next = z * xa.float().exp().type(xa.dtype) + xb
+            residual = (x_next - x).abs().max().item()
+            x = x_next
+            converged = residual <= tol or k + 1 == T - 1
+            stats = {'iters': k + 1, 'residual': residual, 'converged': float(converged)}
+            if converged:
+                break
+        return self.permutation(x, inverse=True), stats
+
 
 class Model(torch.nn.Module):
     VAR_LR: float = 0.1
@@ -296,10 +638,26 @@ class Model(torch.nn.Module):
         self.blocks = torch.nn.ModuleList(blocks)
         # prior for nvp mode should be all ones, but needs to be learnd for the vp mode
         self.register_buffer('var', torch.ones(self.num_patches, pixel_channels))
+        self.checkpointing = 'none'
+        self.checkpoint_every = 1
+        # per-block convergence statistics of the last reverse call with jacobi=True
+        self.jacobi_stats: list[dict[str, float]] = []
         # print number of parameters
         num_params = sum(p.numel() for p in self.parameters())
         print(f'Number of parameters: {num_params / 1e6:.2f}M')
 
+    def set_checkpointing(self, mode: str = 'none', every: int = 1) -> None:
+        """
+        Activation checkpointing for training: 'none', 'block' recomputes every k-th MetaBlock and 'layer' every k-th
+        AttentionBlock of each MetaBlock during backward, instead of storing their activations.
+        """
+        assert mode in ('none', 'block', 'layer'), f'Unknown checkpointing mode {mode}'
+        assert every >= 1
+        self.checkpointing = mode
+        self.checkpoint_every = every
+        for block in self.blocks:
+            block.checkpoint_every = every if mode == 'layer' else 0
+
     def patchify(self, x: torch.Tensor) -> torch.Tensor:
         """Convert an image (N,C',H,W) to a sequence of patches (N,T,C')"""
         u = torch.nn.functional.unfold(x, self.patch_size, stride=self.patch_size)
@@ -316,14 +674,19 @@ class Model(torch.nn.Module):
         self, x: torch.Tensor, y: torch.Tensor | None = None
     ) -> tuple[torch.Tensor, list[torch.Tensor], torch.Tensor]:
         x = self.patchify(x)
-        nan_or_inf(x, "patchify")
+        health.check(x, "patchify")
         outputs = []
         logdets = torch.zeros((), device=x.device)
+        checkpoint = self.checkpointing == 'block' and torch.is_grad_enabled()
         for i in range(self.num_blocks):
             block = self.blocks[i]
-            x, logdet = block(x, y)
-            nan_or_inf(logdet, f"block {i} logdet")
-            nan_or_inf(x, f"block {i} output")
+            with profiler.range('MetaBlock.forward', i):
+                if checkpoint and i % self.checkpoint_every == 0:
+                    x, logdet = torch.utils.checkpoint.checkpoint(block, x, y, use_reentrant=False)
+                else:
+                    x, logdet = block(x, y)
+            health.check(logdet, f"block {i} logdet")
+            health.check(x, f"block {i} output")
             logdets = logdets + logdet
             outputs.append(x)
         return x, outputs, logdets
@@ -344,13 +707,25 @@ class Model(torch.nn.Module):
         attn_temp: float = 1.0,
         annealed_guidance: bool = False,
         return_sequence: bool = False,
+        batch_guidance: bool = True,
+        jacobi: bool = False,
+        jacobi_tol: float = 1e-3,
+        jacobi_max_iters: int | None = None,
     ) -> torch.Tensor | list[torch.Tensor]:
         seq = [self.unpatchify(x)]
         x = x * self.var.sqrt()
+        self.jacobi_stats = []
         for i in range(self.num_blocks-1, -1, -1):
             block = self.blocks[i]
-            x = block.reverse(x, y, guidance, guide_what, attn_temp, annealed_guidance)
-            nan_or_inf(x, f"reverse, block {i} output")
+            with profiler.range('MetaBlock.reverse', i):
+                if jacobi:
+                    x, stats = block.reverse_jacobi(
+                        x, y, guidance, guide_what, attn_temp, annealed_guidance, jacobi_tol, jacobi_max_iters
+                    )
+                    self.jacobi_stats.append({'block': i, **stats})
+                else:
+                    x = block.reverse(x, y, guidance, guide_what, attn_temp, annealed_guidance, batch_guidance)
+            health.check(x, f"reverse, block {i} output")
             seq.append(self.unpatchify(x))
         x = self.unpatchify(x)
 
@@ -358,3 +733,318 @@ class Model(torch.nn.Module):
             return x
         else:
             return seq
+
+
+
+def activation_bytes_per_sample(model: Model, checkpointing: str = 'none', every: int = 1) -> int:
+    """
+    Rough upper bound of the activation memory a single sample needs for a backward pass through model,
+    with the given Model.set_checkpointing settings
+    """
+    T, C = model.num_patches, model.channels
+    layer = model.blocks[0].attn_blocks[0]
+    num_layers = len(model.blocks[0].attn_blocks)
+    expansion = layer.mlp.main[0].out_features // C
+    # norms, qkv, attention output, projections and the mlp hidden states, counted at 4 bytes each
+    per_layer = 4 * T * C * (8 + 3 * expansion)
+    if not Attention.USE_SPDA:
+        per_layer += 2 * 4 * T * T * layer.attention.num_heads  # attention logits and probabilities
+    per_block = num_layers * per_layer + 4 * T * (C + 4 * model.pixel_channels)
+    if checkpointing == 'block':
+        # only the inputs of checkpointed blocks are kept, one block at a time is recomputed during backward
+        num_checkpointed = len(range(0, model.num_blocks, every))
+        stored = num_checkpointed * 4 * T * model.pixel_channels + (model.num_blocks - num_checkpointed) * per_block
+        return stored + per_block
+    if checkpointing == 'layer':
+        num_checkpointed = len(range(0, num_layers, every))
+        per_block -= num_checkpointed * (per_layer - 4 * T * C)
+        return model.num_blocks * per_block + per_layer
+    return model.num_blocks * per_block
+
+
+def self_denoise(
+    model: Model,
+    x: torch.Tensor,
+    y: torch.Tensor | None = None,
+    noise_std: float = 0.05,
+    lr: float = 1.0,
+    steps: int = 1,
+    chunk_size: int | None = None,
+    memory_budget: int | None = None,
+    checkpoint: bool = False,
+    autocast_dtype: torch.dtype | None = torch.bfloat16,
+) -> torch.Tensor:
+    """
+    Denoise samples with gradient steps on the negative log likelihood, x <- x - lr * noise_std**2 * grad log p(x),
+    lr = 1 is the theoretical optimal step. Everything stays on the device of x. Unless chunk_size is given, chunks are
+    sized to fit memory_budget bytes (by default most of the free device memory), checkpoint recomputes each MetaBlock
+    during backward to fit larger chunks.
+    """
+    assert not torch.is_inference_mode_enabled(), 'self_denoise needs autograd, call it outside of inference_mode'
+    if chunk_size is None:
+        if memory_budget is None and x.is_cuda:
+            memory_budget = int(0.8 * torch.cuda.mem_get_info(x.device)[0])
+        if memory_budget is None:
+            chunk_size = x.size(0)
+        else:
+            chunk_size = max(1, memory_budget // activation_bytes_per_sample(model, 'block' if checkpoint else 'none'))
+
+    previous = model.checkpointing, model.checkpoint_every
+    if checkpoint:
+        model.set_checkpointing('block')
+
+    denoised = []
+    for j in range(0, x.size(0), chunk_size):
+        x_j = x[j : j + chunk_size].detach().clone()
+        y_j = y[j : j + chunk_size] if y is not None else None
+        # the loss is a mean over the chunk, the step size is per sample and per dimension
+        step_size = lr * x_j.numel() * noise_std**2
+        for _ in range(steps):
+            x_j.requires_grad_(True)
+            with torch.enable_grad():
+                with torch.autocast(x.device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                    z, _, logdets = model(x_j, y_j)
+                loss = model.get_loss(z, logdets)
+                grad = torch.autograd.grad(loss, [x_j])[0]
+            x_j = x_j.detach().add_(grad, alpha=-step_size)
+        denoised.append(x_j)
+    model.set_checkpointing(*previous)
+    return torch.cat(denoised)
+
+
+def checkpointing_report(
+    model: Model,
+    x: torch.Tensor,
+    y: torch.Tensor | None = None,
+    settings: list[tuple[str, int]] | None = None,
+    autocast_dtype: torch.dtype | None = torch.bfloat16,
+    repeats: int = 3,
+) -> list[dict[str, float | str | int]]:
+    """
+    Peak memory and time of a forward and backward pass of model on the batch x for each (mode, every) setting of
+    Model.set_checkpointing, to pick the fastest setting that fits. The gradients of model are set to None afterwards.
+    """
+    if settings is None:
+        settings = [('none', 1), ('layer', 2), ('layer', 1), ('block', 2), ('block', 1)]
+    previous = model.checkpointing, model.checkpoint_every
+    results = []
+    for mode, every in settings:
+        model.set_checkpointing(mode, every)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+            torch.cuda.reset_peak_memory_stats(x.device)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            with torch.autocast(x.device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                z, _, logdets = model(x, y)
+                loss = model.get_loss(z, logdets)
+            loss.backward()
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            times.append(time.perf_counter() - start)
+            model.zero_grad(set_to_none=True)
+        results.append(
+            {
+                'mode': mode,
+                'every': every,
+                'peak_memory_gib': torch.cuda.max_memory_allocated(x.device) / 2**30 if x.is_cuda else float('nan'),
+                'estimated_gib': x.size(0) * activation_bytes_per_sample(model, mode, every) / 2**30,
+                'step_time': min(times),
+            }
+        )
+    model.set_checkpointing(*previous)
+    return results
+
+def kv_cache_bytes_per_sample(model: Model, storage: str | None = None, dtype: torch.dtype = torch.bfloat16) -> int:
+    """kv cache memory per sample and guidance stream while a MetaBlock is inverted, dtype is the compute dtype"""
+    attention = model.blocks[0].attn_blocks[0].attention
+    num_layers = len(model.blocks[0].attn_blocks)
+    storage_dtype = KVCache.STORAGE_DTYPES[storage] if storage else dtype
+    per_layer = 2 * model.num_patches * model.channels * torch.empty((), dtype=storage_dtype).element_size()
+    if storage == 'int8':
+        per_layer += 2 * model.num_patches * attention.num_heads * 2  # float16 scales
+    return num_layers * per_layer
+
+
+def round_trip_error(model: Model, x: torch.Tensor, y: torch.Tensor | None = None) -> dict[str, float]:
+    """Encode the images x with Model.forward and decode them again with Model.reverse, without guidance"""
+    z, _, _ = model(x, y)
+    x_rec = model.reverse(z / model.var.sqrt(), y)
+    assert isinstance(x_rec, torch.Tensor)
+    error = x_rec.float() - x.float()
+    return {'max_abs_error': error.abs().max().item(), 'rmse': error.square().mean().sqrt().item()}
+
+
+def kv_cache_fidelity(
+    model: Model,
+    x: torch.Tensor,
+    y: torch.Tensor | None = None,
+    storages: tuple[str, ...] = ('bfloat16', 'int8'),
+    **kwargs,
+) -> dict[str, dict[str, float]]:
+    """
+    Sample from the noise x with every low precision kv cache storage and compare to the samples of the full
+    precision cache, kwargs are passed on to Model.reverse. Call under the same inference_mode and autocast as sampling
+    """
+    previous = Attention.KV_CACHE_DTYPE
+    Attention.KV_CACHE_DTYPE = None
+    reference = model.reverse(x.clone(), y, **kwargs)
+    assert isinstance(reference, torch.Tensor)
+    dtype = torch.get_autocast_dtype(x.device.type) if torch.is_autocast_enabled(x.device.type) else x.dtype
+    full_bytes = kv_cache_bytes_per_sample(model, None, dtype)
+    results = {}
+    for storage in storages:
+        Attention.KV_CACHE_DTYPE = storage
+        samples = model.reverse(x.clone(), y, **kwargs)
+        assert isinstance(samples, torch.Tensor)
+        error = samples.float() - reference.float()
+        mse = error.square().mean().item()
+        results[storage] = {
+            'max_abs_error': error.abs().max().item(),
+            'rmse': mse**0.5,
+            'psnr': 10 * math.log10(4 / max(mse, 1e-12)),  # samples are in [-1, 1]
+            'cache_ratio': kv_cache_bytes_per_sample(model, storage, dtype) / full_bytes,
+        }
+    Attention.KV_CACHE_DTYPE = previous
+    return results
+
+
+class StaticSampler:
+    """
+    Model.reverse with static shapes: a fixed batch size, full-length kv caches allocated once, and the patch
+    index passed as a tensor, so that one reverse step can be compiled per block and replayed for every patch.
+    Guidance always runs as a stacked 2B batch. Cache entries that are not written yet are masked out of the
+    attention, so the outputs match the eager path up to the reduction order of the attention kernels, they are not
+    bit-identical to it. static_sampler_error measures the difference.
+    """
+
+    def __init__(self, model: Model, batch_size: int, compile: bool = False):
+        self.model = model
+        self.batch_size = batch_size
+        self.caches: dict[Attention, KVCache] = {}
+        self.step = self.reverse_step
+        if compile:
+            # the step is specialized once per block, not once per patch
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * model.num_blocks)
+            self.step = torch.compile(self.reverse_step, fullgraph=False, dynamic=False)
+
+    def bind_caches(self, block: MetaBlock, rows: int, dtype: torch.dtype, device: torch.device) -> None:
+        for m in block.modules():
+            if isinstance(m, Attention):
+                cache = self.caches.get(m)
+                if (
+                    cache is None
+                    or cache.k is None
+                    or cache.k.size(0) != rows
+                    or cache.dtype != dtype
+                    or cache.storage != m.KV_CACHE_DTYPE
+                ):
+                    cache = KVCache(block.attn_mask.size(0), m.KV_CACHE_DTYPE)
+                    cache.allocate(rows, m.num_heads, m.qkv.out_features // 3 // m.num_heads, dtype, device)
+                    self.caches[m] = cache
+                else:
+                    cache.clear()
+                m.sample = True
+                m.kv_cache = {'cond': cache}
+
+    @staticmethod
+    def reverse_step(
+        block: MetaBlock,
+        x: torch.Tensor,
+        pos: torch.Tensor,
+        pos_embed: torch.Tensor,
+        class_embed: torch.Tensor | None,
+        attn_temp: float | torch.Tensor,
+        guidance: float,
+        guide_what: str,
+        annealed_guidance: bool,
+    ) -> torch.Tensor:
+        """x_pos+1' <- exp(a(x_1', ..., x_pos'))x_pos+1 + b(x_1', ..., x_pos'), with pos a 0-dim tensor"""
+        T = x.size(1)
+        guided = guidance > 0 and bool(guide_what)
+        h = block.proj_in(x.index_select(1, pos)) + pos_embed.index_select(0, pos)
+        if guided:
+            h = torch.cat([h, h])
+        if class_embed is not None:
+            h = h + class_embed
+        for attn_block in block.attn_blocks:
+            h = attn_block(h, attn_temp=attn_temp, pos=pos)
+        h = block.proj_out(h)
+
+        if block.nvp:
+            za, zb = h.chunk(2, dim=-1)
+        else:
+            zb = h
+            za = torch.zeros_like(h)
+        if guided:
+            za, za_u = za.chunk(2)
+            zb, zb_u = zb.chunk(2)
+            g = (pos + 1) / (T - 1) * guidance if annealed_guidance else guidance
+            if 'a' in guide_what:
+                za = za + g * (za - za_u)
+            if 'b' in guide_what:
+                zb = zb + g * (zb - zb_u)
+
+        scale = za.float().exp().type(za.dtype)
+        return x.index_select(1, pos + 1) * scale + zb
+
+    def __call__(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor | None = None,
+        guidance: float = 0,
+        guide_what: str = 'ab',
+        attn_temp: float = 1.0,
+        annealed_guidance: bool = False,
+    ) -> torch.Tensor:
+        assert x.size(0) == self.batch_size, f'StaticSampler is built for batches of {self.batch_size}'
+        model = self.model
+        guided = guidance > 0 and bool(guide_what)
+        if torch.is_autocast_enabled(x.device.type):
+            dtype = torch.get_autocast_dtype(x.device.type)
+        else:
+            dtype = model.var.dtype
+        pos = torch.zeros((), dtype=torch.long, device=x.device)
+
+        x = x * model.var.sqrt()
+        for i in range(model.num_blocks - 1, -1, -1):
+            block = model.blocks[i]
+            x = block.permutation(x)
+            pos_embed = block.permutation(block.pos_embed, dim=0)
+            if guided:
+                class_embed = block.guided_class_embed(y, x.size(0))
+                temp = block.guided_attn_temp(x, attn_temp)
+            else:
+                class_embed = block.embed_class(y)
+                temp = 1.0
+            self.bind_caches(block, x.size(0) * (2 if guided else 1), dtype, x.device)
+            with profiler.range('MetaBlock.reverse', i):
+                for t in range(x.size(1) - 1):
+                    pos.fill_(t)
+                    x_next = self.step(
+                        block, x, pos, pos_embed, class_embed, temp, guidance, guide_what, annealed_guidance
+                    )
+                    x.index_copy_(1, pos + 1, x_next.to(x.dtype))
+            block.set_sample_mode(False)
+            x = block.permutation(x, inverse=True)
+            health.check(x, f"reverse, block {i} output")
+        return model.unpatchify(x)
+
+
+def static_sampler_error(
+    sampler: StaticSampler, x: torch.Tensor, y: torch.Tensor | None = None, **kwargs
+) -> dict[str, float]:
+    """
+    Largest difference between StaticSampler and Model.reverse samples from the noise x, for both attention
+    implementations, kwargs are passed on to both. Call under the same inference_mode and autocast as sampling
+    """
+    previous = Attention.USE_SPDA
+    results = {}
+    for name, use_spda in (('spda', True), ('base', False)):
+        Attention.USE_SPDA = use_spda
+        reference = sampler.model.reverse(x.clone(), y, **kwargs)
+        assert isinstance(reference, torch.Tensor)
+        results[name] = (sampler(x.clone(), y, **kwargs).float() - reference.float()).abs().max().item()
+    Attention.USE_SPDA = previous
+    return results
@@ -3,23 +3,49 @@
 # Copyright (C) 2024 Apple Inc. All Rights Reserved.
 #
 __all__ = [
+    'CachedImageDataset',
+    'CheckpointWriter',
     'CosineLRSchedule',
     'Distributed',
     'FID',
+    'FIDPipeline',
+    'HealthCheck',
     'Metrics',
+    'PreemptionHandler',
+    'Profiler',
+    'ResumableSampler',
+    'ShardSampler',
     'get_data',
+    'get_rng_state',
+    'load_checkpoint',
+    'optimizer_state_by_index',
+    'optimizer_state_by_name',
+    'preprocess_batch',
+    'health',
+    'profiler',
     'set_random_seed',
+    'set_rng_state',
+    'start_trace',
 ]
 
+import bisect
+import contextlib
 import datetime
+import json
 import math
 import os
 import pathlib
+import queue
 import random
+import shutil
+import signal
+import threading
+import time
 
 import numpy as np
 import torch
 import torch.distributed
+import torch.profiler
 import torch.utils.data
 import torchvision as tv
 from torchmetrics.image.fid import FrechetInceptionDistance
@@ -57,24 +83,51 @@ class CosineLRSchedule(torch.nn.Module):
 
 
 class Distributed:
+    """Process group and device of this rank, nccl with one GPU per rank, or gloo on CPU-only hosts"""
 
-    def __init__(self):
+    def __init__(self, device_type: str | None = None):
+        if device_type is None:
+            device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
         if os.environ.get('MASTER_PORT'):  # When running with torchrun
             self.rank = int(os.environ['RANK'])
             self.local_rank = int(os.environ['LOCAL_RANK'])
             self.world_size = int(os.environ['WORLD_SIZE'])
             self.distributed = True
-            torch.distributed.init_process_group('nccl', 'env://', timeout=datetime.timedelta(minutes=10))
+            backend = 'nccl' if device_type == 'cuda' else 'gloo'
+            torch.distributed.init_process_group(backend, 'env://', timeout=datetime.timedelta(minutes=10))
         else:  # When running with python for debugging
             self.rank, self.local_rank, self.world_size = 0, 0, 1
             self.distributed = False
-        torch.cuda.set_device(self.local_rank)
+        if device_type == 'cuda':
+            torch.cuda.set_device(self.local_rank)
+            self.device = torch.device('cuda', self.local_rank)
+        else:
+            self.device = torch.device(device_type)
+            if self.distributed:
+                # share the cores of the host between its ranks
+                local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+                torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
         self.barrier()
 
     def barrier(self) -> None:
         if self.distributed:
             torch.distributed.barrier()
 
+    def all_reduce(
+        self, x: torch.Tensor, op: torch.distributed.ReduceOp.RedOpType = torch.distributed.ReduceOp.SUM
+    ) -> torch.Tensor:
+        if self.distributed:
+            torch.distributed.all_reduce(x, op=op)
+        return x
+
+    def all_reduce_async(
+        self, x: torch.Tensor, op: torch.distributed.ReduceOp.RedOpType = torch.distributed.ReduceOp.SUM
+    ) -> torch.distributed.Work | None:
+        """Start an in-place all_reduce of x, call wait() on the returned handle before reading x"""
+        if not self.distributed:
+            return None
+        return torch.distributed.all_reduce(x, op=op, async_op=True)
+
     def gather_concat(self, x: torch.Tensor) -> torch.Tensor:
         if not self.distributed:
             return x
@@ -82,37 +135,195 @@ class Distributed:
         torch.distributed.all_gather(x_list, x)
         return torch.cat(x_list)
 
+    def gather_object(self, obj) -> list:
+        """Picklable object of every rank, in rank order"""
+        if not self.distributed:
+            return [obj]
+        out = [None] * self.world_size
+        torch.distributed.all_gather_object(out, obj)
+        return out
+
     def __del__(self):
         if self.distributed:
             torch.distributed.destroy_process_group()
 
 
+class ShardSampler(torch.utils.data.Sampler):
+    """Every world_size-th index starting at rank, unlike DistributedSampler no sample is repeated to pad shards"""
+
+    def __init__(self, num_samples: int, rank: int, world_size: int):
+        self.indices = range(rank, num_samples, world_size)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+
+class ResumableSampler(torch.utils.data.DistributedSampler):
+    """DistributedSampler that can skip the first start_index samples of its shard, to resume in the middle of an epoch"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_epoch(self, epoch: int, start_index: int = 0) -> None:
+        super().set_epoch(epoch)
+        self.start_index = start_index
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start_index :])
+
+    def __len__(self) -> int:
+        return self.num_samples - self.start_index
+
+
+class PreemptionHandler:
+    """
+    Records SIGTERM instead of exiting, so that training can save a final checkpoint. Ranks may receive the signal at
+    different steps, should_stop() agrees on the step to stop at with a max reduction every `interval` steps.
+    """
+
+    def __init__(self, dist: Distributed, interval: int = 10, signals: tuple[int, ...] = (signal.SIGTERM,)):
+        self.dist = dist
+        self.interval = interval
+        self.received = False
+        for signum in signals:
+            signal.signal(signum, self.handle)
+
+    def handle(self, signum, frame) -> None:
+        print(f'Rank {self.dist.rank}: received signal {signum}, stopping after the next checkpoint')
+        self.received = True
+
+    def should_stop(self, step: int) -> bool:
+        if not self.dist.distributed:
+            return self.received
+        if step % self.interval:
+            return False
+        flag = torch.tensor([float(self.received)], device=self.dist.device)
+        return bool(self.dist.all_reduce(flag, op=torch.distributed.ReduceOp.MAX).item())
+
+
 class FID(FrechetInceptionDistance):
     def add_state(self, name, default, *args, **kwargs):
         self.register_buffer(name, default)
 
+    @torch.no_grad()
+    def extract_features(self, imgs: torch.Tensor) -> torch.Tensor:
+        """Inception features of a batch of images, preprocessed the same way as in update()"""
+        imgs = (imgs * 255).byte() if self.normalize else imgs
+        features = self.inception(imgs)
+        return features.unsqueeze(0) if features.dim() == 1 else features
+
+    def update_features(self, features: torch.Tensor, real: bool = False) -> None:
+        """Accumulate precomputed Inception features, equivalent to update() on the images they came from"""
+        prefix = 'real' if real else 'fake'
+        self.orig_dtype = features.dtype
+        features = features.double()
+        getattr(self, f'{prefix}_features_sum').add_(features.sum(dim=0))
+        getattr(self, f'{prefix}_features_cov_sum').add_(features.t().mm(features))
+        getattr(self, f'{prefix}_features_num_samples').add_(features.size(0))
+
+    def clear_features(self, real: bool = False) -> None:
+        """Zero the feature statistics, reset() does not since the states are plain buffers rather than metric states"""
+        prefix = 'real' if real else 'fake'
+        for name in ('features_sum', 'features_cov_sum', 'features_num_samples'):
+            getattr(self, f'{prefix}_{name}').zero_()
+
+    def reduce_features(self, dist: Distributed, real: bool = False) -> None:
+        """
+        Sum the feature statistics of all ranks, so that every rank only needs to run Inception on its own shard.
+        Call once after the last update and before compute().
+        """
+        prefix = 'real' if real else 'fake'
+        for name in ('features_sum', 'features_cov_sum', 'features_num_samples'):
+            dist.all_reduce(getattr(self, f'{prefix}_{name}'))
+
+
+class FIDPipeline:
+    """
+    Runs fid.update in a background thread, on its own CUDA stream, behind a queue of at most max_pending batches,
+    so that feature extraction of batch i overlaps with sampling of batch i+1. Batches are consumed in the order
+    they are submitted, and join() must be called before fid.compute().
+    """
+
+    def __init__(self, fid: FID, max_pending: int = 2, real: bool = False):
+        self.fid = fid
+        self.real = real
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.stream: torch.cuda.Stream | None = None
+        self.error: BaseException | None = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, images: torch.Tensor) -> None:
+        """Queue images in [0, 1] for fid.update, blocks while max_pending batches are in flight"""
+        if self.error is not None:
+            raise self.error
+        event = None
+        if images.is_cuda:
+            if self.stream is None:
+                self.stream = torch.cuda.Stream(device=images.device)
+            event = torch.cuda.Event()
+            event.record()
+            images.record_stream(self.stream)
+        self.queue.put((images, event))
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            images, event = item
+            if self.error is not None:
+                continue
+            try:
+                if event is None:
+                    with torch.inference_mode():
+                        self.fid.update(images, real=self.real)
+                else:
+                    assert self.stream is not None
+                    with torch.cuda.device(images.device), torch.cuda.stream(self.stream), torch.inference_mode():
+                        self.stream.wait_event(event)
+                        self.fid.update(images, real=self.real)
+            except BaseException as e:
+                self.error = e
+
+    def join(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.stream is not None:
+            torch.cuda.current_stream(self.stream.device).wait_stream(self.stream)
+        if self.error is not None:
+            raise self.error
+
 
 class Metrics:
+    """Running (weighted) sums of metrics kept on the device, reduced across ranks in a single all_reduce"""
+
     def __init__(self):
-        self.metrics: dict[str, list[float]] = {}
+        self.sums: dict[str, torch.Tensor | float] = {}
+        self.weights: dict[str, torch.Tensor | float] = {}
 
-    def update(self, metrics: dict[str, torch.Tensor | float]):
+    def update(self, metrics: dict[str, torch.Tensor | float], weight: torch.Tensor | float = 1.0):
         for k, v in metrics.items():
             if isinstance(v, torch.Tensor):
-                v = v.item()
-            if k in self.metrics:
-                self.metrics[k].append(v)
-            else:
-                self.metrics[k] = [v]
+                v = v.detach().float()
+            self.sums[k] = self.sums.get(k, 0.0) + v * weight
+            self.weights[k] = self.weights.get(k, 0.0) + weight
 
     def compute(self, dist: Distributed | None) -> dict[str, float]:
-        out: dict[str, float] = {}
-        for k, v in self.metrics.items():
-            v = sum(v) / len(v)
-            if dist is not None:
-                v = dist.gather_concat(torch.tensor(v, device='cuda').view(1)).mean().item()
-            out[k] = v
-        return out
+        keys = sorted(self.sums)
+        if not keys:
+            return {}
+        values = [self.sums[k] for k in keys] + [self.weights[k] for k in keys]
+        device = next((v.device for v in values if isinstance(v, torch.Tensor)), torch.device('cpu'))
+        packed = torch.stack([torch.as_tensor(v, dtype=torch.float32, device=device) for v in values])
+        if dist is not None:
+            dist.all_reduce(packed)
+        sums, weights = packed.view(2, len(keys))
+        return dict(zip(keys, (sums / weights).tolist()))
 
     @staticmethod
     def print(metrics: dict[str, float], epoch: int):
@@ -124,16 +335,7 @@ def get_num_classes(dataset: str) -> int:
     return {'imagenet64': 0, 'imagenet': 1000, 'afhq': 3, 'cifar': 10}[dataset]
 
 
-def get_data(dataset: str, img_size: int, folder: pathlib.Path) -> tuple[torch.utils.data.Dataset, int]:
-    transform = tv.transforms.Compose(
-        [
-            tv.transforms.Resize(img_size),
-            tv.transforms.CenterCrop(img_size),
-            tv.transforms.RandomHorizontalFlip(),
-            tv.transforms.ToTensor(),
-            tv.transforms.Normalize((0.5,), (0.5,)),
-        ]
-    )
+def load_dataset(dataset: str, folder: pathlib.Path, transform) -> torch.utils.data.Dataset:
     if dataset == 'imagenet64':
         data = tv.datasets.ImageFolder(str(folder / 'imagenet64'), transform=transform)
     elif dataset == 'imagenet':
@@ -144,7 +346,72 @@ def get_data(dataset: str, img_size: int, folder: pathlib.Path) -> tuple[torch.u
         data = tv.datasets.CIFAR10(root=str(folder / 'cifar'), train=True, download=True, transform=transform)
     else:
         raise NotImplementedError(f'Unknown dataset {dataset}')
-    return data, get_num_classes(dataset)
+    return data
+
+
+def get_cache_dir(dataset: str, img_size: int, folder: pathlib.Path) -> pathlib.Path:
+    return folder / f'{dataset}_{img_size}_cache'
+
+
+class CachedImageDataset(torch.utils.data.Dataset):
+    """Images already resized to uint8 (C, H, W) and stored in memory-mapped shards, see prepare_data_cache.py"""
+
+    def __init__(self, path: pathlib.Path, transform=None):
+        self.path = path
+        self.transform = transform
+        self.meta = json.loads((path / 'meta.json').read_text())
+        self.labels = [np.load(path / shard['labels']) for shard in self.meta['shards']]
+        self.offsets = np.cumsum([0] + [shard['size'] for shard in self.meta['shards']]).tolist()
+        # opened lazily, so that every data loader worker maps the files itself instead of pickling them
+        self.images: list[np.ndarray] | None = None
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, int]:
+        if self.images is None:
+            self.images = [np.load(self.path / shard['images'], mmap_mode='r') for shard in self.meta['shards']]
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        i = index - self.offsets[shard]
+        x = torch.from_numpy(np.array(self.images[shard][i]))
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, int(self.labels[shard][i])
+
+
+def get_data(dataset: str, img_size: int, folder: pathlib.Path) -> tuple[torch.utils.data.Dataset, int]:
+    """Datasets of uint8 (C, H, W) images, flips and normalization run on the device in preprocess_batch"""
+    cache_dir = get_cache_dir(dataset, img_size, folder)
+    if (cache_dir / 'meta.json').exists():
+        return CachedImageDataset(cache_dir), get_num_classes(dataset)
+
+    transform = tv.transforms.Compose(
+        [
+            tv.transforms.Resize(img_size),
+            tv.transforms.CenterCrop(img_size),
+            tv.transforms.PILToTensor(),
+        ]
+    )
+    return load_dataset(dataset, folder, transform), get_num_classes(dataset)
+
+
+def preprocess_batch(
+    x: torch.Tensor, noise_type: str | None = None, noise_std: float = 0.0, flip: bool = False
+) -> torch.Tensor:
+    """
+    uint8 images (B, C, H, W) -> float images in [-1, 1], with optional random horizontal flips and either
+    gaussian noise or uniform dequantization noise, in one batched stage on the device of x
+    """
+    if flip:
+        mask = torch.rand(x.size(0), 1, 1, 1, device=x.device) < 0.5
+        x = torch.where(mask, x.flip(dims=[3]), x)
+    x = x.float()
+    if noise_type == 'uniform':
+        return (x + torch.rand_like(x)) / 256 * 2 - 1
+    x = x / 127.5 - 1
+    if noise_type == 'gaussian':
+        x = x + noise_std * torch.randn_like(x)
+    return x
 
 
 def set_random_seed(seed: int) -> None:
@@ -154,12 +421,297 @@ def set_random_seed(seed: int) -> None:
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
-def nan_or_inf(x: torch.Tensor, s:str) -> bool:
-    if torch.any(torch.isnan(x)):
-        print(f"Warning! NaN detected in "+s)
-    elif torch.any(torch.isinf(x)):
-        print(f"Warning! Inf detected in "+s)
-    return
+
+def get_rng_state() -> dict:
+    """State of every random number generator of this process, in a form torch.load(weights_only=True) accepts"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+
+class HealthCheck:
+    """
+    Counts NaN and Inf values per named site in device tensors, without synchronizing with the host. The counts are
+    only read back by report(), which step() calls every `interval` steps (0 leaves it to the caller, eg at the end of
+    an epoch). When disabled, check() returns immediately.
+    """
+
+    def __init__(self, enabled: bool = True, interval: int = 0):
+        self.enabled = enabled
+        self.interval = interval
+        self.counts: dict[str, torch.Tensor] = {}
+        self.steps = 0
+
+    def configure(self, enabled: bool | None = None, interval: int | None = None) -> None:
+        if enabled is not None:
+            self.enabled = enabled
+        if interval is not None:
+            self.interval = interval
+
+    def check(self, x: torch.Tensor, site: str) -> None:
+        if not self.enabled:
+            return
+        counts = torch.stack([torch.isnan(x).sum(), torch.isinf(x).sum()])
+        # accumulate out of place, so counts created under inference_mode can still be updated outside of it
+        self.counts[site] = self.counts[site] + counts if site in self.counts else counts
+
+    def step(self) -> None:
+        self.steps += 1
+        if self.interval and self.steps % self.interval == 0:
+            self.report()
+
+    def report(self) -> dict[str, tuple[int, int]]:
+        """Read back and reset the counts, warn about every site with non-finite values"""
+        if not self.counts:
+            return {}
+        sites = list(self.counts)
+        values = torch.stack([self.counts[k] for k in sites]).tolist()
+        self.counts = {}
+        out = {}
+        for site, (nan, inf) in zip(sites, values):
+            if nan:
+                print(f"Warning! {nan} NaN values detected in {site}")
+            if inf:
+                print(f"Warning! {inf} Inf values detected in {site}")
+            out[site] = (nan, inf)
+        return out
+
+
+health = HealthCheck()
+
+
+class Profiler:
+    """
+    Named ranges for torch.profiler traces, with wall-clock totals per name. Disabled, range() returns a shared
+    nullcontext, so instrumented code only pays for a method call. Enabled, the totals are host times, which include
+    device work only where the host waits for it. With synchronize, every range synchronizes the device before and
+    after so that the totals are device times, at the cost of stalling the device queue in every range.
+    """
+
+    def __init__(self, enabled: bool = False, synchronize: bool = False):
+        self.enabled = enabled
+        self.synchronize = synchronize
+        self.totals: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.null = contextlib.nullcontext()
+
+    def configure(self, enabled: bool | None = None, synchronize: bool | None = None) -> None:
+        if enabled is not None:
+            self.enabled = enabled
+        if synchronize is not None:
+            self.synchronize = synchronize
+
+    def range(self, name: str, index: int | None = None) -> contextlib.AbstractContextManager:
+        """A range called name, or 'name index', the name is only formatted when enabled"""
+        if not self.enabled:
+            return self.null
+        return self.timed(name if index is None else f'{name} {index}')
+
+    def sync(self) -> None:
+        if self.synchronize and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        with torch.profiler.record_function(name):
+            self.sync()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.sync()
+                self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self) -> None:
+        self.totals = {}
+        self.counts = {}
+
+    def summary(self) -> str:
+        """Table of calls, total and mean time per range, longest first"""
+        lines = [f'{"range":40s} {"calls":>8s} {"total (s)":>12s} {"mean (ms)":>12s}']
+        for name in sorted(self.totals, key=self.totals.__getitem__, reverse=True):
+            total, count = self.totals[name], self.counts[name]
+            lines.append(f'{name:40s} {count:8d} {total:12.3f} {1000 * total / count:12.3f}')
+        return '\n'.join(lines)
+
+
+profiler = Profiler()
+
+
+def start_trace(
+    path: pathlib.Path, active: int = 5, wait: int = 1, warmup: int = 1, synchronize: bool = False
+) -> torch.profiler.profile:
+    """
+    Start torch.profiler for `active` steps after `wait` + `warmup` steps and enable the profiler ranges until the
+    trace is written. Call step() after every step and stop() at the end, the Chrome trace is written to path and a
+    table of the top ops printed
+    """
+    cuda = torch.cuda.is_available()
+
+    def export(prof: torch.profiler.profile) -> None:
+        # the rest of the run goes without ranges, the range totals cover the traced steps
+        profiler.configure(enabled=False)
+        prof.export_chrome_trace(str(path))
+        print(prof.key_averages().table(sort_by='cuda_time_total' if cuda else 'cpu_time_total', row_limit=25))
+        print(f'Saved trace to {path}')
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if cuda:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler.configure(enabled=True, synchronize=synchronize)
+    trace = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=export,
+    )
+    trace.start()
+    return trace
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints without holding up training. save() only copies the state into reused pinned host buffers,
+    a background thread then writes each file to a temporary path and atomically renames it into place, so a crash
+    never leaves a truncated checkpoint behind. With a tag, every file is saved as {stem}_{tag}{suffix} and the
+    plain path is relinked to it, keeping the last `keep` tagged versions of each series.
+    """
+
+    def __init__(self, keep: int = 1):
+        self.keep = keep
+        self.history: dict[tuple[pathlib.Path, str], list[pathlib.Path]] = {}
+        self.buffers: dict[pathlib.Path, list[torch.Tensor]] = {}
+        self.queue: queue.Queue = queue.Queue()
+        self.error: BaseException | None = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def track_existing(self, path: pathlib.Path, series: str, pattern: str) -> None:
+        """Retain the files {stem}_{pattern}{suffix} left by an earlier run as the oldest tagged versions of series"""
+        found = sorted(path.parent.glob(f'{path.stem}_{pattern}{path.suffix}'))
+        self.history[(path, series)] = found + self.history.get((path, series), [])
+
+    def snapshot(self, state, buffers: list[torch.Tensor], i: int = 0):
+        """Copy every tensor in a nested state dict into host buffers, returns the copy and the next buffer index"""
+        if isinstance(state, torch.Tensor):
+            if i == len(buffers) or buffers[i].shape != state.shape or buffers[i].dtype != state.dtype:
+                buffer = torch.empty(state.shape, dtype=state.dtype, pin_memory=state.is_cuda)
+                buffers[i : i + 1] = [buffer]
+            buffers[i].copy_(state.detach(), non_blocking=True)
+            return buffers[i], i + 1
+        if isinstance(state, dict):
+            out = {}
+            for k, v in state.items():
+                out[k], i = self.snapshot(v, buffers, i)
+            return out, i
+        if isinstance(state, (list, tuple)):
+            out = []
+            for v in state:
+                v, i = self.snapshot(v, buffers, i)
+                out.append(v)
+            return type(state)(out), i
+        return state, i
+
+    def save(self, files: dict[pathlib.Path, dict], tag: str | None = None, series: str = '') -> None:
+        """
+        Snapshot one state dict per file and queue them for writing, waits for the previous save to finish first.
+        Tagged files of different series, eg per-epoch and mid-epoch checkpoints, do not push each other out
+        """
+        self.wait()
+        snapshots = {}
+        for path, state in files.items():
+            snapshots[path], _ = self.snapshot(state, self.buffers.setdefault(path, []))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.queue.put((snapshots, tag, series))
+
+    def write(self, path: pathlib.Path, state: dict, tag: str | None, series: str = '') -> None:
+        target = path.with_stem(f'{path.stem}_{tag}') if tag else path
+        tmp = target.with_name(f'.{target.name}.tmp')
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+        if not tag:
+            return
+        tmp = path.with_name(f'.{path.name}.tmp')
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(target, tmp)
+        except OSError:  # file systems without hard links
+            shutil.copyfile(target, tmp)
+        os.replace(tmp, path)
+        history = self.history.setdefault((path, series), [])
+        if target in history:  # rewritten after resuming from an earlier checkpoint
+            history.remove(target)
+        history.append(target)
+        while len(history) > self.keep:
+            history.pop(0).unlink(missing_ok=True)
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                snapshots, tag, series = item
+                if self.error is None:
+                    for path, state in snapshots.items():
+                        self.write(path, state, tag, series)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self) -> None:
+        """Block until all queued checkpoints are on disk"""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self) -> None:
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def load_checkpoint(path: str | pathlib.Path, weights_only: bool = True):
+    """Load a checkpoint to the CPU, memory-mapping the file so that tensors are only read when they are used"""
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=weights_only)
+
+
+def optimizer_state_by_name(state: dict, names: list[str]) -> dict:
+    """torch.optim state dict keyed by parameter index -> keyed by parameter name, the format FSDP uses"""
+    return {
+        'state': {names[i]: v for i, v in state['state'].items()},
+        'param_groups': [{**g, 'params': [names[i] for i in g['params']]} for g in state['param_groups']],
+    }
+
+
+def optimizer_state_by_index(state: dict, names: list[str]) -> dict:
+    """Inverse of optimizer_state_by_name, so that sharded and unsharded runs save the same checkpoint format"""
+    index = {name: i for i, name in enumerate(names)}
+    return {
+        'state': {index[k]: v for k, v in state['state'].items()},
+        'param_groups': [{**g, 'params': [index[k] for k in g['params']]} for g in state['param_groups']],
+    }
+
 
 def sqa_save(x: torch.Tensor, path, nrow=10):
     # default x is [-1, 1]